@@ -43,9 +43,9 @@ class AblationHardware:
 
     def _update_cache(self):
         while True:
-            _, data = self._plume_camera.grab_json_data()
+            _, data = self._plume_camera.latest()
             if data is not None: self._cache = data
-            if data is None and self._cache is not None: break
+            if self._cache is not None: break
 
     def _monitor_move(self, motor, steps):
         """
@@ -15,18 +15,16 @@ class PMT:
 
         # Labjack gain controller
         self._monitor = connect_to('scope')
+        self._cache = None
 #        self._gain_controller = USBTMCDevice(31419, mode='multiplexed', name='PMT Gain Control')
 
     def _update_cache(self):
         while True:
-            _, data = self._monitor.grab_json_data()
-            if data is None:
-                if self._cache is not None:
-                    break
-                else:
-                    time.sleep(0.5)
+            _, data = self._monitor.latest()
             if data is not None and 'ch1' in data:
                 self._cache = data
+            if self._cache is not None: break
+            time.sleep(0.5)
 
     def off(self):
         self.gain = 0
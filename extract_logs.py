@@ -1,11 +1,16 @@
 # live plot system log files
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import json, datetime
 
 import numpy as np
 
 from colorama import Style, Fore
 
+from headers.log_store import load_fields
+from headers.log_index import read_lines
+from headers.field_extractor import compile_fields
+
 
 ##### PARAMETERS #####
 # What period of logs to dump.
@@ -79,66 +84,115 @@ fields = {
 }
 
 
+# Where to read logs from.
+# 'text': daily JSON text logs (system_logs/*.txt).
+# 'columnar': columnar log store written by logger.py (see headers/log_store.py). Much faster.
+LOG_FORMAT = 'text'
+
+
+# Process one day per worker process when reading text logs.
+# Set WORKERS to None to use all cores.
+PARALLEL = True
+WORKERS = None
+
+
 ##### Begin Extract #####
-assert START_TIME < END_TIME
-print(f'Extracting logs on from {START_TIME[0]} {START_TIME[1]} to {END_TIME[0]} {END_TIME[1]}...')
-log_dir = Path('~/Desktop/edm_data/logs/system_logs').expanduser() 
-
-processed_data = []
-for path in sorted(log_dir.glob('*.txt')):
-    if START_TIME[0] > path.stem or END_TIME[0] < path.stem: continue
-
-    with path.open('r') as f:
-        for i, line in enumerate(f):
-            timestamp, data = line.split(']', 1)
-            timestamp = timestamp[1:]
-            time_only = timestamp.split(' ')[1]
-            if START_TIME[0] == path.stem and START_TIME[1] > time_only: continue
-            if END_TIME[0] == path.stem and END_TIME[1] < time_only: continue
-
-            data = json.loads(data)
-
-            entries = []
-            uncertainties = []
-            try:
-                for data_path in fields.values():
-                    value = data
-                    for entry in data_path:
-                        value = value[entry]
-
-                    if isinstance(value, list):
-                        entries.append(value[0])
-                        uncertainties.append(value[1])
-                    else:
-                        entries.append(value)
-                        uncertainties.append(0)
-            except KeyError:
-                continue
+LOG_DIR = Path('~/Desktop/edm_data/logs/system_logs').expanduser()
+
 
+extract_fields = compile_fields(list(fields.values()))
 
-            if i % 1234 == 0:
-                print(f'\r[{timestamp}] {Style.BRIGHT}{len(processed_data):10d}{Style.RESET_ALL} {Fore.YELLOW}entries processed{Style.RESET_ALL}', end='')
 
+def extract_day(path):
+    """Extract the requested fields from one daily text log. Returns an array of rows."""
+    processed_data = []
+
+    # Preallocated row: [timestamp, *values, *uncertainties]
+    row = np.empty(1 + 2 * len(fields))
+    values, sigmas = row[1:1+len(fields)], row[1+len(fields):]
+
+    # Seek straight to the requested times on the first and last day
+    start = START_TIME[1] if path.stem == START_TIME[0] else None
+    end = END_TIME[1] if path.stem == END_TIME[0] else None
+    for line in read_lines(path, start, end):
+        timestamp, data = line.split(']', 1)
+        timestamp = timestamp[1:]
+        time_only = timestamp.split(' ')[1]
+        if START_TIME[0] == path.stem and START_TIME[1] > time_only: continue
+        if END_TIME[0] == path.stem and END_TIME[1] < time_only: continue
+
+        data = json.loads(data)
+
+        # Skip entries where any field is missing or not a number
+        if extract_fields(data, values, sigmas): continue
+
+        try:
+            timestamp = datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
+        except:
             try:
-                timestamp = datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
+                timestamp = datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
             except:
-                try:
-                    timestamp = datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-                except:
-                    continue
-
-            if all(isinstance(x, float) for x in entries):
-                processed_data.append([timestamp.timestamp(), *entries, *uncertainties])
-
-print()
-print(f'Writing {len(processed_data)} entries to extract.txt...')
-processed_data = np.array(processed_data)
-np.savetxt(
-    'extract.txt',
-    processed_data,
-    header=', '.join(
+                continue
+
+        row[0] = timestamp.timestamp()
+        processed_data.append(row.copy())
+
+    return np.array(processed_data, dtype=float).reshape(-1, 1 + 2 * len(fields))
+
+
+def extract_text_logs():
+    paths = [
+        path for path in sorted(LOG_DIR.glob('*.txt'))
+        if START_TIME[0] <= path.stem <= END_TIME[0]
+    ]
+
+    def report(path, block, total):
+        print(f'[{path.stem}] {Style.BRIGHT}{len(block):8d}{Style.RESET_ALL} {Fore.YELLOW}entries{Style.RESET_ALL} {Style.DIM}({total} total){Style.RESET_ALL}')
+
+    blocks = []
+    if PARALLEL and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=WORKERS) as pool:
+            for path, block in zip(paths, pool.map(extract_day, paths)):
+                blocks.append(block)
+                report(path, block, sum(map(len, blocks)))
+    else:
+        for path in paths:
+            blocks.append(extract_day(path))
+            report(path, blocks[-1], sum(map(len, blocks)))
+
+    if not blocks: return np.zeros((0, 1 + 2 * len(fields)))
+
+    # Merge in timestamp order
+    processed_data = np.concatenate(blocks)
+    return processed_data[np.argsort(processed_data[:, 0], kind='stable')]
+
+
+def extract_columnar_logs():
+    start = datetime.datetime.strptime(' '.join(START_TIME), '%Y-%m-%d %H:%M:%S').timestamp()
+    end = datetime.datetime.strptime(' '.join(END_TIME), '%Y-%m-%d %H:%M:%S').timestamp()
+
+    times, values, sigmas = load_fields(list(fields.values()), start, end)
+
+    # Same as text logs: skip entries where any field is missing
+    valid = np.isfinite(values).all(axis=1)
+    return np.column_stack([times, values, sigmas])[valid]
+
+
+if __name__ == '__main__':
+    assert START_TIME < END_TIME
+    print(f'Extracting logs on from {START_TIME[0]} {START_TIME[1]} to {END_TIME[0]} {END_TIME[1]}...')
+
+    if LOG_FORMAT == 'columnar':
+        processed_data = extract_columnar_logs()
+    else:
+        processed_data = extract_text_logs()
+
+    header = ', '.join(
         ['unix timestamp'] +
         [f'{name} [{unit}]' for name, unit in fields.keys()] +
         [f'{name} uncertainty [{unit}]' for name, unit in fields.keys()]
     )
-)
+
+    print(f'Writing {len(processed_data)} entries to extract.txt and extract.npz...')
+    np.savetxt('extract.txt', processed_data, header=header)
+    np.savez('extract.npz', data=processed_data, header=header)
@@ -3,6 +3,8 @@ import re
 import telnetlib
 import time
 
+from colorama import Fore, Style
+
 from headers.usbtmc import USBTMCDevice
 
 
@@ -36,6 +38,8 @@ class CTC100(USBTMCDevice):
         self._set_variable('system.com.verbose', 'Medium')
         self._set_variable('system.display.Figures', 4)
 
+        self._output_names = None # Cached by read_many
+
         
     def _get_variable(self, var):
         """
@@ -114,6 +118,36 @@ class CTC100(USBTMCDevice):
         return float(match.group()) if match is not None else None
 
 
+    def read_many(self, channels):
+        """
+        Read several channels with a single 'getOutput' query, which returns
+        the values of all channels at once. Returns {channel: value}.
+        Channels that can't be found in the output list are read one at a time.
+        """
+        if self._output_names is None:
+            names = self.query('getOutput.names')
+            if names is not None: self._output_names = [_normalize(name) for name in names.split(',')]
+
+        response = self.query('getOutput')
+        values = response.split(',') if response is not None and self._output_names is not None else []
+        if values and len(values) != len(self._output_names):
+            print(f'  [{Fore.YELLOW}WARN{Style.RESET_ALL}] CTC100 returned {len(values)} outputs for {len(self._output_names)} names. Reading channels individually.')
+            self._output_names = None # Names may have changed, so get them again next time
+            values = []
+        outputs = dict(zip(self._output_names or [], values))
+
+        result = {}
+        for channel in channels:
+            value = outputs.get(_normalize(channel))
+            if value is None:
+                result[channel] = self.read(channel)
+                continue
+
+            match = re.search(r"[-+]?\d*\.\d+", value)
+            result[channel] = float(match.group()) if match is not None else None
+        return result
+
+
     def ramp_temperature(self, channel, temp=0.0, rate=0.1):
         self._set_variable(f"{channel}.PID.mode", "off") #This should reset the ramp temperature to the current temperature.
         self._set_variable(f"{channel}.PID.Ramp", str(rate))
@@ -137,3 +171,8 @@ class CTC100(USBTMCDevice):
     @property
     def channels(self) -> List[str]:
         return self.query('getOutput.names').split(',')
+
+
+def _normalize(name):
+    """Channel names are case-insensitive, and spaces in them are optional."""
+    return name.replace(' ', '').lower()
@@ -0,0 +1,75 @@
+"""
+Compiled lookups of many nested fields in edm-monitor data.
+
+plotter.py and extract_logs.py pull a fixed list of paths, e.g.
+('ablation', 'center', 'x'), out of every log entry. Instead of walking
+each path with a loop and try/except per line, compile_fields()
+generates one Python function for the whole list. Shared prefixes are
+looked up only once, and results go straight into preallocated arrays.
+
+Usage:
+    extract = compile_fields([('flows', 'cell'), ('temperatures', 'saph')])
+    values, sigmas = np.empty(2), np.empty(2)
+    missing = extract(data, values, sigmas)
+"""
+import math
+
+
+def compile_fields(paths):
+    """
+    Compile a list of paths into a function f(data, values, sigmas) -> missing.
+
+    For each path i, values[i] and sigmas[i] are set from the entry in data:
+      - [value, uncertainty] or (value, uncertainty) of numbers -> value, uncertainty
+      - a number -> value, 0
+      - anything else (missing, None, string, ...) -> nan, 0
+    Only ints, floats and bools (as 0/1) count as numbers, so numeric strings like '1.5' are missing too.
+    Returns the number of paths that were not numbers.
+    """
+    # Build a trie of keys, so that shared prefixes are looked up once.
+    trie = {}
+    for i, path in enumerate(paths):
+        node = trie
+        for key in path:
+            node = node.setdefault(key, {})
+        node.setdefault(None, []).append(i)
+
+    lines = [
+        'def extract(data, values, sigmas):',
+        '    missing = 0',
+    ]
+    counter = iter(range(1, 1 << 30))
+
+    def emit(node, var, indent):
+        pad = ' ' * indent
+        for key, child in node.items():
+            if key is None: continue
+            sub = f'x{next(counter)}'
+            lines.append(f'{pad}{sub} = {var}.get({key!r}) if {var}.__class__ is dict else None')
+
+            for i in child.get(None, []):
+                lines.extend(pad + line for line in [
+                    f'cls = {sub}.__class__',
+                    f'if (cls is list or cls is tuple) and len({sub}) == 2 and {sub}[0].__class__ in numbers and {sub}[1].__class__ in numbers:',
+                    f'    values[{i}] = {sub}[0]',
+                    f'    sigmas[{i}] = {sub}[1]',
+                    f'elif cls in numbers:',
+                    f'    values[{i}] = {sub}',
+                    f'    sigmas[{i}] = 0.0',
+                    f'else:',
+                    f'    values[{i}] = nan',
+                    f'    sigmas[{i}] = 0.0',
+                    f'    missing += 1',
+                ])
+            emit(child, sub, indent)
+
+    emit(trie, 'data', 4)
+    lines.append('    return missing')
+
+    source = '\n'.join(lines)
+    namespace = {'nan': math.nan, 'numbers': (float, int, bool)}
+    exec(compile(source, '<compiled fields>', 'exec'), namespace)
+
+    extract = namespace['extract']
+    extract.source = source
+    return extract
@@ -0,0 +1,205 @@
+"""
+Shared-memory ring buffers for camera frames.
+
+Camera threads write each raw frame into a FrameWriter, and publish only its
+sequence number over ZMQ. Viewers on the same machine map the ring with a
+FrameReader and get the frame back as a numpy array, with no PNG encoding or
+decoding. PNGs are only sent over ZMQ if SEND_PNG is set, for viewers on other
+machines or for archiving. With the default (SEND_PNG = False), subscribers on
+other machines only get sequence numbers, and no images.
+
+Layout: a header, then one metadata record per slot, then one data block per slot.
+A slot's sequence number is -1 while it is being written, so readers can tell
+when a frame was overwritten while they were reading it.
+"""
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+
+SEND_PNG = False # Also send PNG images over ZMQ. Needed by viewers on other machines.
+FRAME_SLOTS = 4 # Frames kept in each ring
+MAX_DIMS = 4
+
+MAGIC = int.from_bytes(b'EDMFRAME', 'little')
+
+HEADER = np.dtype([
+    ('magic', '<u8'),
+    ('slots', '<i8'),
+    ('slot_bytes', '<i8'),
+    ('latest', '<i8'), # Sequence number of the newest frame, or -1
+    ('closed', '<i8'), # Set when the writer is done with this ring
+])
+
+SLOT = np.dtype([
+    ('seq', '<i8'),
+    ('timestamp', '<f8'),
+    ('dtype', 'S8'),
+    ('ndim', '<i8'),
+    ('shape', '<i8', (MAX_DIMS,)),
+    ('nbytes', '<i8'),
+])
+
+
+_written = set() # Rings written by this process
+
+def _shm_name(name): return f'edm-{name}'
+
+def _open(name):
+    try:
+        return shared_memory.SharedMemory(_shm_name(name), track=False) # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(_shm_name(name))
+        # Otherwise, the segment is deleted when this process exits, even though the writer still uses it
+        if name not in _written: resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def _views(shm):
+    header = np.ndarray((), HEADER, buffer=shm.buf)
+    slots, slot_bytes = int(header['slots']), int(header['slot_bytes'])
+    meta = np.ndarray((slots,), SLOT, buffer=shm.buf, offset=HEADER.itemsize)
+    data = np.ndarray((slots, slot_bytes), np.uint8, buffer=shm.buf, offset=HEADER.itemsize + slots * SLOT.itemsize)
+    return header, meta, data
+
+
+
+class FrameWriter:
+    def __init__(self, name, slots=FRAME_SLOTS):
+        self.name = name
+        self.slots = slots
+        self._shm = None
+
+        # Unique across restarts, so readers never mix up frames from an old ring
+        self.seq = time.time_ns() // 1000
+
+    def write(self, frame, timestamp=None):
+        """Copy a frame (numpy array) into the ring. Returns its sequence number."""
+        frame = np.ascontiguousarray(frame)
+        if frame.ndim > MAX_DIMS: raise ValueError(f'Frames can have at most {MAX_DIMS} dimensions')
+        if self._shm is None or frame.nbytes > self._data.shape[1]: self._allocate(frame.nbytes)
+
+        self.seq += 1
+        i = self.seq % self.slots
+
+        self._meta['seq'][i] = -1
+        self._data[i, :frame.nbytes] = frame.reshape(-1).view(np.uint8)
+        self._meta['timestamp'][i] = time.time() if timestamp is None else timestamp
+        self._meta['dtype'][i] = frame.dtype.str
+        self._meta['ndim'][i] = frame.ndim
+        self._meta['shape'][i, :frame.ndim] = frame.shape
+        self._meta['nbytes'][i] = frame.nbytes
+        self._meta['seq'][i] = self.seq
+
+        self._header['latest'] = self.seq
+        return self.seq
+
+    def _allocate(self, slot_bytes):
+        """(Re)create the ring, with room for frames of the given size."""
+        self.close()
+
+        size = HEADER.itemsize + self.slots * (SLOT.itemsize + slot_bytes)
+        try:
+            self._shm = shared_memory.SharedMemory(_shm_name(self.name), create=True, size=size)
+        except FileExistsError:
+            # Left over from a writer that crashed
+            old = shared_memory.SharedMemory(_shm_name(self.name))
+            old.close()
+            old.unlink()
+            self._shm = shared_memory.SharedMemory(_shm_name(self.name), create=True, size=size)
+
+        _written.add(self.name)
+
+        header = np.ndarray((), HEADER, buffer=self._shm.buf)
+        header['slots'] = self.slots
+        header['slot_bytes'] = slot_bytes
+        header['latest'] = -1
+        header['closed'] = 0
+
+        self._header, self._meta, self._data = _views(self._shm)
+        self._meta['seq'] = -1
+        header['magic'] = MAGIC
+
+    def close(self):
+        if self._shm is None: return
+        self._header['closed'] = 1
+
+        # Views must be released before the memory can be unmapped
+        self._header = self._meta = self._data = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    ##### Context Manager Magic Methods #####
+    def __enter__(self): return self
+    def __exit__(self, exception_type, exception_value, traceback): self.close()
+
+
+
+class FrameReader:
+    def __init__(self, name):
+        self.name = name
+        self._shm = None
+
+    def read(self, seq=None, copy=True):
+        """
+        Return (seq, timestamp, frame) for the frame with the given sequence
+        number, or the newest frame if seq is None. Returns None if the frame
+        is not available (overwritten, or no writer on this machine).
+
+        With copy=False, the frame is a read-only view into shared memory,
+        which the writer will overwrite after FRAME_SLOTS more frames.
+        """
+        if self._shm is None or self._header['closed']: self._attach()
+        result = self._read(seq, copy)
+
+        # The writer may have restarted with a new ring
+        if result is None and seq is not None:
+            self._attach()
+            result = self._read(seq, copy)
+        return result
+
+    def _read(self, seq, copy):
+        if self._shm is None: return None
+        if seq is None: seq = int(self._header['latest'])
+        if seq < 0: return None
+
+        i = seq % len(self._meta)
+        if self._meta['seq'][i] != seq: return None
+
+        dtype = np.dtype(self._meta['dtype'][i].decode('ascii'))
+        shape = tuple(self._meta['shape'][i, :self._meta['ndim'][i]])
+        timestamp = float(self._meta['timestamp'][i])
+        frame = self._data[i, :self._meta['nbytes'][i]].view(dtype).reshape(shape)
+        if copy: frame = frame.copy()
+
+        # Check that the frame wasn't overwritten while reading
+        if self._meta['seq'][i] != seq: return None
+        return seq, timestamp, frame
+
+    def _attach(self):
+        self.close()
+        try:
+            shm = _open(self.name)
+        except FileNotFoundError:
+            return
+
+        header, meta, data = _views(shm)
+        if header['magic'] != MAGIC:
+            # Not initialized yet
+            header = meta = data = None
+            shm.close()
+            return
+
+        for view in [header, meta, data]: view.flags.writeable = False
+        self._shm = shm
+        self._header, self._meta, self._data = header, meta, data
+
+    def close(self):
+        if self._shm is None: return
+        self._header = self._meta = self._data = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass # Frames read with copy=False still use it. Unmapped once they are gone.
+        self._shm = None
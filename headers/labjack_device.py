@@ -1,27 +1,145 @@
+import threading, time
+
 from labjack import ljm
 
 import numpy as np
 
 from uncertainties import ufloat
 
+try:
+    from headers.ring_buffer import RingBuffer
+except:
+    from ring_buffer import RingBuffer
+
+
+##### Stream Mode #####
+# Channels given as `stream_channels` are sampled continuously by the Labjack
+# at STREAM_SCAN_RATE, into a ring buffer holding the last STREAM_BUFFER_TIME.
+# Reads of those channels then return statistics of the latest samples immediately.
+# Note that command-response reads of other AIN channels are not possible while streaming.
+STREAM_SCAN_RATE = 1000 # Hz, per channel
+STREAM_READS_PER_SECOND = 20 # How often the buffer is updated
+STREAM_BUFFER_TIME = 5 # s
+STREAM_AVERAGE_TIME = 0.1 # s, averaged by default when reading a streamed channel
+
+
 class Labjack:
-    def __init__(self, serial_number):
+    def __init__(self, serial_number, stream_channels=None):
         self.handle = ljm.openS("T7", "Ethernet", serial_number)
         # For test: string "-2" opens fake device. "ANY" opens any T7.
 
-    def read(self, channel, n_samples=8):
-        # Average out some noise automatically
-        samples = []
-        for i in range(n_samples):
-            samples.append(ljm.eReadName(self.handle, channel))
-        return ufloat(np.mean(samples), np.std(samples))
+        self._stream_lock = threading.Lock()
+        self._stream_channels = {}
+        if stream_channels:
+            try:
+                self.start_stream(stream_channels)
+            except ljm.LJMError as e:
+                # Still usable with command-response reads
+                print('Could not start Labjack stream:', e)
+
+    def read(self, channel, n_samples=None):
+        """
+        Read a channel, averaging out some noise automatically.
+
+        n_samples: How many samples to average. For streamed channels,
+            defaults to the last STREAM_AVERAGE_TIME of samples. Otherwise 8.
+        """
+        return self.read_many([channel], n_samples)[0]
+
+    def read_many(self, channels, n_samples=None):
+        """
+        Read several channels as one snapshot, returning a list of ufloats.
+        Streamed channels share the same samples. Others are read together with eReadNames.
+        """
+        # The stream may stop at any time, so work from a snapshot of its channels
+        with self._stream_lock: stream_channels = self._stream_channels
+
+        streamed = [c for c in channels if c in stream_channels]
+        results = dict(zip(streamed, self._read_stream(stream_channels, streamed, n_samples))) if streamed else {}
+
+        others = [c for c in channels if c not in results]
+        if others:
+            samples = np.array([
+                ljm.eReadNames(self.handle, len(others), others)
+                for i in range(n_samples or 8)
+            ])
+            for channel, column in zip(others, samples.T):
+                results[channel] = ufloat(np.mean(column), np.std(column))
+
+        return [results[c] for c in channels]
 
     def write(self, channel, value):
         success = ljm.eWriteName(self.handle, channel, value)
         return success
 
     def close(self):
+        self.stop_stream()
         ljm.close(self.handle)
 
+
+    ##### Stream Mode #####
+    def start_stream(self, channels):
+        """Start streaming the given channels (e.g. ['AIN0', 'AIN1']) into a ring buffer."""
+        self.stop_stream()
+
+        addresses, _ = ljm.namesToAddresses(len(channels), channels)
+        scans_per_read = max(1, int(STREAM_SCAN_RATE / STREAM_READS_PER_SECOND))
+
+        # Let the Labjack choose settling time and resolution
+        ljm.eWriteName(self.handle, 'STREAM_SETTLING_US', 0)
+        ljm.eWriteName(self.handle, 'STREAM_RESOLUTION_INDEX', 0)
+        self.scan_rate = ljm.eStreamStart(self.handle, scans_per_read, len(addresses), addresses, STREAM_SCAN_RATE)
+
+        with self._stream_lock:
+            self._stream_buffer = RingBuffer(int(STREAM_BUFFER_TIME * self.scan_rate), shape=(len(channels),))
+            self._stream_channels = {channel: i for i, channel in enumerate(channels)}
+
+        self._stream_thread = threading.Thread(target=self._stream_loop, args=(len(channels),), daemon=True)
+        self._stream_thread.start()
+
+    def stop_stream(self):
+        with self._stream_lock:
+            if not self._stream_channels: return
+            self._stream_channels = {}
+        try:
+            ljm.eStreamStop(self.handle)
+        except ljm.LJMError as e:
+            print('Error stopping Labjack stream:', e)
+
+    def _stream_loop(self, n_channels):
+        while self._stream_channels:
+            try:
+                data, device_backlog, ljm_backlog = ljm.eStreamRead(self.handle)
+            except ljm.LJMError as e:
+                # Fall back to command-response reads
+                print('Labjack stream stopped:', e)
+                self.stop_stream()
+                return
+
+            # Samples are interleaved by channel. Skipped samples are marked with a dummy value.
+            scans = np.array(data, dtype=float).reshape(-1, n_channels)
+            scans[scans == -9999] = np.nan
+            with self._stream_lock:
+                self._stream_buffer.extend(scans)
+
+    def _read_stream(self, stream_channels, channels, n_samples=None):
+        indices = [stream_channels[c] for c in channels]
+        n_samples = n_samples or max(1, int(STREAM_AVERAGE_TIME * self.scan_rate))
+
+        # Wait for the first samples after starting
+        deadline = time.monotonic() + 1
+        while len(self._stream_buffer) == 0 and time.monotonic() < deadline: time.sleep(1e-2)
+
+        with self._stream_lock:
+            samples = self._stream_buffer.filled()[-n_samples:, indices].copy()
+
+        results = []
+        for channel, column in zip(channels, samples.T):
+            column = column[np.isfinite(column)]
+            if len(column) == 0: raise RuntimeError(f'No stream samples for {channel}')
+            results.append(ufloat(np.mean(column), np.std(column)))
+        return results
+
+
 if __name__ == '__main__':
     lj = Labjack(470022275)
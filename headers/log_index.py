@@ -0,0 +1,116 @@
+"""
+Sidecar minute index for the daily text logs.
+
+For each log file YYYY-MM-DD.txt, YYYY-MM-DD.idx stores the byte offset of
+the first line of every minute:
+
+    HH:MM <offset>
+
+logger.py appends entries as it writes. Index files that are missing or
+behind the log are brought up to date lazily on first read, by scanning
+forward from the last indexed minute.
+"""
+from pathlib import Path
+
+
+def index_path(log_path):
+    return Path(log_path).with_suffix('.idx')
+
+
+def _minute(line):
+    """Return 'HH:MM' from a log line like b'[2022-05-10 14:03:12.345] {...}', or None if it doesn't parse."""
+    minute = line[12:17].decode('utf-8', errors='replace')
+    if len(minute) != 5 or minute[2] != ':' or not (minute[:2] + minute[3:]).isdigit(): return None
+    return minute
+
+
+def load_index(log_path):
+    """
+    Return [(minute, offset), ...] for the given log, sorted by offset.
+    Updates the sidecar file if the log has grown since it was indexed.
+    """
+    log_path = Path(log_path)
+    idx_path = index_path(log_path)
+
+    # Read existing entries (keep earliest offset for each minute)
+    offsets = {}
+    if idx_path.exists():
+        with idx_path.open('r') as f:
+            for line in f:
+                try:
+                    minute, offset = line.split()
+                    offset = int(offset)
+                except ValueError:
+                    continue
+                offsets[minute] = min(offset, offsets.get(minute, offset))
+
+    # Scan the rest of the file, starting from the last indexed minute
+    resume = max(offsets.values(), default=0)
+    new_entries = []
+    with log_path.open('rb') as f:
+        f.seek(resume)
+        offset = resume
+        for line in f:
+            if not line.endswith(b'\n'): break # Line still being written
+
+            minute = _minute(line)
+            if minute is not None and minute not in offsets:
+                offsets[minute] = offset
+                new_entries.append((minute, offset))
+            offset += len(line)
+
+    if new_entries:
+        with idx_path.open('a') as f:
+            for minute, offset in new_entries:
+                print(minute, offset, file=f)
+
+    return sorted(offsets.items(), key=lambda entry: entry[1])
+
+
+_last_recorded = {} # log path -> last minute recorded
+
+def record(log_path, minute, offset):
+    """
+    Called by the logger before writing a line at `offset`.
+    Appends an index entry whenever a new minute starts.
+    """
+    log_path = Path(log_path)
+    if _last_recorded.get(log_path) == minute: return
+    _last_recorded[log_path] = minute
+
+    with index_path(log_path).open('a') as f:
+        print(minute, offset, file=f)
+
+
+def read_lines(log_path, start=None, end=None):
+    """
+    Yield lines (str) of the log between start and end times ('HH:MM:SS'),
+    seeking directly to the relevant region. Lines in the same minute as
+    start/end are included, so callers should still filter exact times.
+    """
+    begin, stop = 0, None
+    if start is not None or end is not None:
+        index = load_index(log_path)
+
+        # The logger takes the timestamp before picking the file, so a file can start
+        # with lines from 23:59 of the previous day. Skip those leading entries, but only if
+        # the minute wraps right after them (later clock steps leave the index alone).
+        lead = 0
+        while lead < len(index) and index[lead][0].startswith('23:'): lead += 1
+        if 0 < lead < len(index) and index[lead][0] < index[lead-1][0]: index = index[lead:]
+
+        if start is not None:
+            after = [offset for minute, offset in index if minute >= start[:5]]
+            if not after: return
+            begin = after[0]
+        if end is not None:
+            after = [offset for minute, offset in index if offset >= begin and minute > end[:5]]
+            if after: stop = after[0]
+
+    with Path(log_path).open('rb') as f:
+        f.seek(begin)
+        offset = begin
+        for line in f:
+            if stop is not None and offset >= stop: break
+            offset += len(line)
+            yield line.decode('utf-8', errors='replace')
@@ -0,0 +1,293 @@
+"""
+Columnar storage for the edm-monitor system logs.
+
+Each message is flattened into columns, one per leaf of the data tree
+(e.g. 'flows/cell'). Every column stores a value and an uncertainty as
+float64 (NaN where missing). Rows are grouped into chunks of
+CHUNK_MINUTES, each saved as one compressed .npz file:
+
+    <root>/<YYYY-MM-DD>/<HHMM>.npz
+
+While a chunk is open, new rows are written every FLUSH_INTERVAL as numbered
+parts (<HHMM>.001.npz, ...), which are merged into <HHMM>.npz once the chunk
+is complete. Readers include any parts that haven't been merged yet.
+
+Loading a field over a time range only opens the chunks in that range,
+and only decompresses the requested columns.
+
+Usage:
+    writer = LogWriter()
+    writer.append(time.time(), data)
+
+    times, values, sigmas = load_fields([('flows', 'cell')], start, end)
+
+To convert existing text logs:
+    python -m headers.log_store 2022-05-10 2022-05-26
+"""
+import os
+import time
+import datetime
+from pathlib import Path
+
+import numpy as np
+
+
+ROOT_DIR = Path('~/Desktop/edm_data/logs/columnar/').expanduser()
+TEXT_LOG_DIR = Path('~/Desktop/edm_data/logs/system_logs/').expanduser()
+
+CHUNK_MINUTES = 10
+FLUSH_INTERVAL = 60 # seconds. Write new rows this often, so a crash loses little data.
+
+SEPARATOR = '/'
+
+
+##### Flattening #####
+def column_name(path):
+    return SEPARATOR.join(path)
+
+
+def flatten(tree, prefix=()):
+    """
+    Flatten a nested data dict into {column name: (value, uncertainty)}.
+    (value, uncertainty) pairs become one column. Strings and other
+    non-numeric leaves are skipped.
+    """
+    columns = {}
+    for key, value in tree.items():
+        path = (*prefix, str(key))
+
+        if isinstance(value, dict):
+            columns.update(flatten(value, path))
+            continue
+
+        if isinstance(value, (list, tuple)) and len(value) == 2 and all(_is_number(x) for x in value):
+            columns[column_name(path)] = (_to_float(value[0]), _to_float(value[1]))
+        elif _is_number(value):
+            columns[column_name(path)] = (_to_float(value), 0.0 if value is not None else np.nan)
+    return columns
+
+
+def _is_number(x):
+    return x is None or isinstance(x, (int, float, np.number))
+
+def _to_float(x):
+    return np.nan if x is None else float(x)
+
+
+
+##### Writing #####
+def chunk_start(timestamp):
+    """Return the unix time at which the chunk containing timestamp starts."""
+    t = datetime.datetime.fromtimestamp(timestamp)
+    t = t.replace(minute=t.minute - t.minute % CHUNK_MINUTES, second=0, microsecond=0)
+    return t.timestamp()
+
+
+def chunk_path(start, root=ROOT_DIR):
+    t = datetime.datetime.fromtimestamp(start)
+    return Path(root) / t.strftime('%Y-%m-%d') / (t.strftime('%H%M') + '.npz')
+
+
+def part_paths(path):
+    """Return the unmerged parts of the chunk at path, in order."""
+    return sorted(path.parent.glob(f'{path.stem}.[0-9][0-9][0-9].npz'))
+
+
+def write_chunk(path, times, rows):
+    """Save a list of flattened rows as one chunk. The file is replaced atomically."""
+    names = sorted(set().union(*rows)) if rows else []
+
+    arrays = {'time': np.array(times, dtype=np.float64)}
+    for name in names:
+        column = np.array([row.get(name, (np.nan, np.nan)) for row in rows], dtype=np.float64)
+        arrays[f'value:{name}'] = column[:, 0]
+        arrays[f'sigma:{name}'] = column[:, 1]
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp.npz')
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_chunk(path):
+    """Inverse of write_chunk. Returns (times, rows)."""
+    with np.load(path) as chunk:
+        times = list(chunk['time'])
+        names = [key[len('value:'):] for key in chunk.files if key.startswith('value:')]
+        columns = {name: (chunk[f'value:{name}'], chunk[f'sigma:{name}']) for name in names}
+
+    rows = [{} for _ in times]
+    for name, (values, sigmas) in columns.items():
+        for row, value, sigma in zip(rows, values, sigmas):
+            if not (np.isnan(value) and np.isnan(sigma)): row[name] = (value, sigma)
+    return times, rows
+
+
+def merge_chunk(path):
+    """Merge the parts of a chunk (and the chunk itself, if it exists) into one file."""
+    parts = part_paths(path)
+    if not parts: return
+
+    times, rows = read_chunk(path) if path.exists() else ([], [])
+    for part in parts:
+        part_times, part_rows = read_chunk(part)
+        times += part_times
+        rows += part_rows
+
+    order = np.argsort(times, kind='stable')
+    write_chunk(path, [times[i] for i in order], [rows[i] for i in order])
+    for part in parts: part.unlink()
+
+
+class LogWriter:
+    """
+    Buffers rows for the current chunk. New rows are written as a part every
+    FLUSH_INTERVAL, and the parts are merged when the chunk is complete.
+    """
+
+    def __init__(self, root=ROOT_DIR):
+        self.root = Path(root)
+        self._chunk = None
+        self._parts = 0 # Parts of the current chunk on disk
+        self._times = []
+        self._rows = []
+        self._last_flush = time.monotonic()
+
+    def append(self, timestamp, data):
+        start = chunk_start(timestamp)
+        if start != self._chunk:
+            self._finish_chunk()
+            self._start_chunk(start)
+
+        self._times.append(timestamp)
+        self._rows.append(flatten(data))
+
+        if time.monotonic() - self._last_flush > FLUSH_INTERVAL:
+            self.flush()
+
+    def _start_chunk(self, start):
+        self._chunk = start
+        self._times, self._rows = [], []
+
+        # Chunk already has parts (e.g. logger restarted): keep numbering after them.
+        parts = part_paths(chunk_path(start, self.root))
+        self._parts = int(parts[-1].suffixes[-2][1:]) if parts else 0
+
+    def _finish_chunk(self):
+        if self._chunk is None: return
+        path = chunk_path(self._chunk, self.root)
+
+        if self._parts == 0 and not path.exists():
+            # Nothing on disk yet, so skip the parts
+            if self._times: write_chunk(path, self._times, self._rows)
+        else:
+            self.flush()
+            merge_chunk(path)
+
+        self._chunk = None
+        self._times, self._rows = [], []
+
+    def flush(self):
+        """Write the rows added since the last flush as a new part of the current chunk."""
+        self._last_flush = time.monotonic()
+        if self._chunk is None or not self._times: return
+
+        self._parts += 1
+        path = chunk_path(self._chunk, self.root)
+        write_chunk(path.with_suffix(f'.{self._parts:03d}.npz'), self._times, self._rows)
+        self._times, self._rows = [], []
+
+    def close(self): self._finish_chunk()
+
+    ##### Context Manager Magic Methods #####
+    def __enter__(self): return self
+    def __exit__(self, exception_type, exception_value, traceback): self.close()
+
+
+
+##### Reading #####
+def chunks_in_range(start, end, root=ROOT_DIR):
+    """Return the paths of all chunks (and unmerged parts) overlapping [start, end] (unix times), in order."""
+    root = Path(root)
+    first = chunk_start(start)
+
+    paths = []
+    day = datetime.date.fromtimestamp(first)
+    while day <= datetime.date.fromtimestamp(end):
+        day_dir = root / day.strftime('%Y-%m-%d')
+
+        # A chunk that is still open (or was never merged) only has parts
+        names = {path.name[:4] for path in day_dir.glob('[0-9][0-9][0-9][0-9].*npz') if not path.name.endswith('.tmp.npz')}
+        for name in sorted(names):
+            t = datetime.datetime.strptime(f'{day_dir.name} {name}', '%Y-%m-%d %H%M').timestamp()
+            if not (first <= t <= end): continue
+
+            path = day_dir / f'{name}.npz'
+            if path.exists(): paths.append(path)
+            paths.extend(part_paths(path))
+        day += datetime.timedelta(days=1)
+    return paths
+
+
+def load_fields(fields, start, end, root=ROOT_DIR):
+    """
+    Load the given fields between start and end (unix times).
+
+    fields: list of paths into the data tree, e.g. [('flows', 'cell')].
+    Returns (times, values, sigmas), where values and sigmas have shape (N, len(fields)).
+    """
+    names = [column_name(path) for path in fields]
+
+    all_times, all_values, all_sigmas = [], [], []
+    for path in chunks_in_range(start, end, root):
+        with np.load(path) as chunk:
+            times = chunk['time']
+            mask = (times >= start) & (times <= end)
+            if not mask.any(): continue
+
+            values = np.full((mask.sum(), len(names)), np.nan)
+            sigmas = np.full((mask.sum(), len(names)), np.nan)
+            for i, name in enumerate(names):
+                if f'value:{name}' not in chunk.files: continue
+                values[:, i] = chunk[f'value:{name}'][mask]
+                sigmas[:, i] = chunk[f'sigma:{name}'][mask]
+
+        all_times.append(times[mask])
+        all_values.append(values)
+        all_sigmas.append(sigmas)
+
+    if not all_times:
+        return np.zeros(0), np.zeros((0, len(names))), np.zeros((0, len(names)))
+    times = np.concatenate(all_times)
+
+    # Parts of a chunk written before and after a restart may overlap in time
+    order = np.argsort(times, kind='stable')
+    return times[order], np.concatenate(all_values)[order], np.concatenate(all_sigmas)[order]
+
+
+
+##### Conversion from text logs #####
+def import_text_logs(start_date, end_date, root=ROOT_DIR, log_dir=TEXT_LOG_DIR):
+    """Convert daily text logs (YYYY-MM-DD.txt) in the given date range into chunks."""
+    import json
+
+    for path in sorted(Path(log_dir).glob('*.txt')):
+        if not (start_date <= path.stem <= end_date): continue
+        print(f'Importing {path.name}...')
+
+        with LogWriter(root) as writer, path.open('r') as f:
+            for line in f:
+                try:
+                    timestamp, data = line.split(']', 1)
+                    timestamp = timestamp[1:]
+                    fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in timestamp else '%Y-%m-%d %H:%M:%S'
+                    timestamp = datetime.datetime.strptime(timestamp, fmt).timestamp()
+                    data = json.loads(data)
+                except ValueError:
+                    continue
+                writer.append(timestamp, data)
+
+
+if __name__ == '__main__':
+    import sys
+    import_text_logs(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else sys.argv[1])
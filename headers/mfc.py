@@ -27,6 +27,26 @@ class MFC(USBTMCDevice):
         val = ufloat(*map(float, val.split()))
         return val/5 * self._calibration[channel]
 
+    def read_all(self):
+        """Read all flows (sccm) from one snapshot of all channels, in a single request. Returns None if the read fails."""
+        try:
+            val = self.query('READ_MANY AIN0 AIN1 AIN2')
+            if val is None: return None
+            val = [float(x) for x in val.split()]
+        except (OSError, ValueError) as e:
+            # Multiplexer down, timed out, or returned an error
+            print('MFC read failed:', e)
+            return None
+        flows = [ufloat(n, s)/5 * cal for n, s, cal in zip(val[::2], val[1::2], self._calibration)]
+
+        cell_1 = flows[0]/3 # Temporary hack while MFCs are parallel
+        return {
+            'cell': cell_1 + flows[2],
+            'cell1': cell_1,
+            'cell2': flows[2],
+            'neon': flows[1],
+        }
+
     def _set_flow_rate(self, flowrate, channel): #0.0V = flow is off; 5.0V = open valve
         self.send_command(f'DAC{channel} {5 * flowrate/self._calibration[channel]:.8f}')
         time.sleep(1.0) #Takes about 1s to ramp up the flow.
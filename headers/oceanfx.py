@@ -2,29 +2,28 @@
 Header file for the Ocean Optics OceanFX spectrometer.
 """
 
-import socket, time
+import socket, time, threading, queue
 
 import numpy as np
 from scipy.optimize import curve_fit
 
 from colorama import Fore, Style
 
-from uncertainties import ufloat
+from uncertainties import ufloat, correlated_values
 import uncertainties.unumpy as unp
-from uncertainties.unumpy import uarray, nominal_values, std_devs
-
-from headers.util import fit
+from headers.util import display_statistics, display_parameters
+from headers.uncertain_array import UncertainArray, stack, log
 
 
 # Dumped from packet capture
-def pad_packet(message_type, content):
+def pad_packet(message_type, content, request_id=0):
     return (
         b'\xc1\xc0' # Constant start bytes
         + b'\x00\x00' # Protocol Version
         + b'\x00\x00' # Flags
         + b'\x00\x00' # Error number
         + message_type
-        + b'\x00\x00\x00\x00' # Request ID (will be echoed back)
+        + request_id.to_bytes(4, byteorder='little') # Request ID (will be echoed back)
         + b'\x00\x00\x00\x00\x00\x00' # Useless, reserved
         + b'\x00' # Checksum type (useless)
         + content
@@ -47,6 +46,7 @@ def parse_packet(packet):
     flag = FLAGS[flag] if flag < 7 else f'Unknown Flag {flag}'
     error = int.from_bytes(packet[6:8], byteorder='little')
     msg_type = packet[8:12]
+    request_id = int.from_bytes(packet[12:16], byteorder='little')
 
     immediate_data_length = int(packet[23])
     immediate_data = packet[24:24 + immediate_data_length]
@@ -57,17 +57,102 @@ def parse_packet(packet):
         'flag': flag,
         'error': error,
         'type': msg_type,
+        'id': request_id,
         'immediate': immediate_data,
         'payload': payload
     }
 
 
+def parse_spectra(packet):
+    """Decode a spectrum response into (error, integration times, spectra)."""
+    data = parse_packet(packet)
+
+    payload = data['payload']
+    segment_length = 64 + 2 * SPECTRUM_LENGTH + 4
+    n_spectra, checksum = divmod(len(payload), segment_length)
+    if data['error'] == 0 and checksum != 0:
+        raise RuntimeError('Invalid packet length!')
+
+    # Extract metadata, then decode
+    # from little-endian 16-byte unsigned int.
+    integration_times = []
+    samples = []
+    for i in range(n_spectra):
+        segment = payload[segment_length*i : segment_length*(i+1)]
+        metadata = segment[:64]
+        sample = np.frombuffer(segment[64:-4], dtype=np.uint16)
+
+        # Extract spectrum length and integration time.
+        spectrum_length = int.from_bytes(metadata[4:8], byteorder='little')
+        integration_time = int.from_bytes(metadata[16:20], byteorder='little')
+
+        # Return if spectrum has expected length.
+        if spectrum_length == 2 * SPECTRUM_LENGTH:
+            integration_times.append(integration_time)
+            samples.append(sample)
+
+    return data['error'], integration_times, samples
+
+
 
 
 SPECTRUM_LENGTH = 2136
 OCEANFX_WAVELENGTHS = np.loadtxt('calibration/wavelengths.txt')
 HENE_MASK = (OCEANFX_WAVELENGTHS < 630) | (OCEANFX_WAVELENGTHS > 634)
 
+HEADER_LENGTH = 44
+GET_SPECTRA = b'\x80\x09\x10\x00' # Message type of spectrum requests and responses
+FOOTER = b'\xc5\xc4\xc3\xc2'
+RECEIVE_BUFFER_SIZE = 1 << 17 # Fits a response with 15 spectra
+
+# Read responses on a background thread, while the next spectra are already requested.
+# The thread takes every packet on the connection: spectra are matched to their requests
+# by request ID, and replies to other commands are passed on to whoever is waiting for them.
+PIPELINED = True
+REQUESTS_IN_FLIGHT = 2
+
+
+# Batched weighted linear fits, one line per row of y.
+def fit_lines(x, y, sigma, mask):
+    """
+    Weighted least-squares fit y = slope * x + intercept for every row of y at once.
+
+    x: (M,) shared abscissa. y, sigma, mask: (N, M); points where mask is False are ignored.
+    Returns (slopes, intercepts, cov, reduced chisq, number of points), as arrays over rows.
+    cov has shape (N, 2, 2), ordered (slope, intercept), and like np.polyfit(..., cov=True)
+    is scaled by the reduced chisq. Rows with fewer than 3 points get slope 0 ± 1000,
+    intercept 1000 ± 1000 and chisq nan.
+    """
+    weights = mask / np.square(sigma)
+    points = mask.sum(axis=1)
+
+    # Center x on its weighted mean for numerical stability
+    S = weights.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = (weights @ x) / S
+        dx = x[None, :] - x_mean[:, None]
+        Sxx = (weights * dx**2).sum(axis=1)
+
+        slopes = (weights * dx * y).sum(axis=1) / Sxx
+        intercepts = (weights * y).sum(axis=1) / S - slopes * x_mean
+
+        residuals = y - (slopes[:, None] * x[None, :] + intercepts[:, None])
+        dof = points - 2
+        chisqs = (weights * residuals**2).sum(axis=1) / dof
+
+        cov = np.empty((len(y), 2, 2))
+        cov[:, 0, 0] = chisqs / Sxx
+        cov[:, 1, 1] = chisqs * (1/S + x_mean**2 / Sxx)
+        cov[:, 0, 1] = cov[:, 1, 0] = -chisqs * x_mean / Sxx
+
+    failed = (dof < 1) | ~(Sxx > 0)
+    slopes[failed] = 0
+    intercepts[failed] = 1000
+    chisqs[failed] = np.nan
+    cov[failed] = np.diag([1000**2, 1000**2])
+    return slopes, intercepts, cov, chisqs, points
+
+
 
 # Utilities for fitting surface roughness
 def roughness_model(
@@ -80,14 +165,50 @@ def roughness_model(
     return beta_0 - 1e6 * beta_2 * wavenumber**2 - 1e3 * beta_4 * wavenumber**4
 
 
+ROUGHNESS_PARAMETERS = {
+    'log_I0': (np.log(100), ''),
+    '\\beta_2': (1, 'micron$^2$'),
+    '\\beta_4': (0, 'micron nm$^3$'),
+}
+
+
+def solve_roughness(wavelengths, log_transmission, sigma):
+    """
+    Weighted least-squares fit of roughness_model, which is linear in its parameters.
+    Returns (params, cov, reduced chisq) as plain arrays, with cov scaled by the reduced chisq
+    (same convention as curve_fit with absolute_sigma=False).
+    """
+    valid = np.isfinite(log_transmission) & (sigma > 0)
+    wavenumber = 2*np.pi/wavelengths[valid]
+    sigma = sigma[valid]
+
+    # Columns are the derivatives of roughness_model with respect to each parameter
+    design = np.column_stack([
+        np.ones_like(wavenumber),
+        -1e6 * wavenumber**2,
+        -1e3 * wavenumber**4,
+    ]) / sigma[:, None]
+    y = log_transmission[valid] / sigma
+
+    # Solve via SVD, since the columns differ in scale by many orders of magnitude
+    u, singular_values, vt = np.linalg.svd(design, full_matrices=False)
+    params = vt.T @ ((u.T @ y) / singular_values)
+
+    dof = len(y) - len(params)
+    chisq = np.square(y - design @ params).sum() / dof
+    cov = (vt.T / singular_values**2) @ vt * chisq
+    return params, cov, float(chisq)
+
+
 ior = 1.23
-def fit_roughness(wavelengths, transmission):
-    p0 = {
-        'log_I0': (np.log(100), ''),
-        '\\beta_2': (1, 'micron$^2$'),
-        '\\beta_4': (0, 'micron nm$^3$'),
-    }
-    params, meta, residuals = fit(roughness_model, wavelengths, unp.log(transmission), p0)
+def fit_roughness(wavelengths, transmission, quiet=True):
+    log_transmission = log(transmission)
+    popt, pcov, chisq = solve_roughness(wavelengths, log_transmission.n, log_transmission.s)
+    params = correlated_values(popt, pcov, tags=ROUGHNESS_PARAMETERS.keys())
+
+    if not quiet:
+        display_statistics(len(wavelengths) - len(params), chisq)
+        display_parameters(params, ROUGHNESS_PARAMETERS)
 
     # Compute roughness
     beta_0, beta_2, beta_4 = params
@@ -104,7 +225,7 @@ def fit_roughness(wavelengths, transmission):
     return [
         I0, roughness,
         *params,
-        meta[1]['chisq/dof'],
+        chisq,
     ]
 
 
@@ -113,7 +234,13 @@ class OceanFX:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.settimeout(3)
 
+        # Preallocated receive buffer, filled with recv_into
+        self._buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._filled = 0
+
         self.sock.connect((ip_addr, port))
+        self._reader = None
         self.ping()
 
         self._cache = None
@@ -123,14 +250,31 @@ class OceanFX:
         # Disable buffering
         self.send(b'\x10\x08\x10\x00', 0, data_length=1)
 
+        if PIPELINED:
+            self._spectra = queue.Queue() # (request ID, parsed response or exception)
+            self._replies = queue.Queue() # Packets that aren't spectra
+            self._pending = set() # IDs of spectrum requests in flight
+            self._request_id = 0
+            self._reader = threading.Thread(target=self._read_loop, daemon=True)
+            self._reader.start()
+
 
     def load_calibration(self):
-        self.background = uarray(*np.loadtxt('calibration/background.txt'))
-        self.baseline = uarray(*np.loadtxt('calibration/baseline.txt'))
+        self.background = UncertainArray(*np.loadtxt('calibration/background.txt'))
+        self.baseline = UncertainArray(*np.loadtxt('calibration/baseline.txt'))
         self.baseline -= self.background
     
     def close(self):
+        if self.sock is None: return
+
+        # Shutting down wakes the reader thread, which exits once the socket is closed
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
+        self.sock = None
+        if self._reader is not None: self._reader.join(timeout=5)
 
     def reset(self):
         """Reset the device if it stops responding."""
@@ -138,14 +282,24 @@ class OceanFX:
 
     def ping(self):
         """Try to ping the device."""
+        if self._reader is None:
+            self.send(b'\x01\xF1\x0F\x00', 31415)
+            return parse_packet(self._read_packet())
+
+        # The reader thread receives the reply. Skip any left over from earlier commands (e.g. reset).
+        while not self._replies.empty(): self._replies.get_nowait()
         self.send(b'\x01\xF1\x0F\x00', 31415)
-        return parse_packet(self.sock.recv(8192))
+        try:
+            return parse_packet(self._replies.get(timeout=self.sock.gettimeout()))
+        except queue.Empty:
+            raise RuntimeError('OceanFX timed out')
 
-    def send(self, message_type, data, data_length=4):
+    def send(self, message_type, data, data_length=4, request_id=0):
         self.sock.send(pad_packet(
             message_type,
             data_length.to_bytes(1, byteorder='little')
-            + int(data).to_bytes(16, byteorder='little')
+            + int(data).to_bytes(16, byteorder='little'),
+            request_id
         ))
 
     def set_averaging(self, n_scans: int):
@@ -153,66 +307,149 @@ class OceanFX:
         self.send(b'\x10\x00\x12\x00', n_scans, data_length=2)
 
 
-    def _capture_sample(self):
+    def _read_packet(self):
+        """Return the next complete packet, reading into the receive buffer as needed."""
+        view = self._view
+        while True:
+            if self._filled >= HEADER_LENGTH:
+                length = HEADER_LENGTH + int.from_bytes(view[40:44], byteorder='little')
+                if length > len(view):
+                    self._filled = 0
+                    raise RuntimeError(f'OceanFX packet too long ({length} bytes)')
+
+                if self._filled >= length:
+                    packet = bytes(view[:length])
+
+                    # Move any bytes of the next packet to the front
+                    remaining = self._filled - length
+                    view[:remaining] = view[length:self._filled]
+                    self._filled = remaining
+
+                    if not packet.endswith(FOOTER):
+                        raise RuntimeError('Invalid packet footer!')
+                    return packet
+
+            n = self.sock.recv_into(view[self._filled:])
+            if n == 0: raise ConnectionError('OceanFX closed the connection')
+            self._filled += n
+
+
+    def _read_loop(self):
+        """
+        Reader thread for pipelined mode. Puts parsed spectrum responses (or exceptions)
+        into one queue, and packets of any other type into another.
+        """
+        while True:
+            try:
+                packet = self._read_packet()
+            except socket.timeout:
+                continue
+            except OSError:
+                return # Socket closed
+            except Exception as e:
+                self._spectra.put((None, e))
+                continue
+
+            if packet[8:12] != GET_SPECTRA:
+                self._replies.put(packet)
+                continue
+
+            request_id = int.from_bytes(packet[12:16], byteorder='little')
+            try:
+                self._spectra.put((request_id, parse_spectra(packet)))
+            except Exception as e:
+                self._spectra.put((request_id, e))
+
+
+    def _next_response(self):
+        """Return the response to the next spectrum request in flight."""
+        while True:
+            request_id, response = self._spectra.get(timeout=self.sock.gettimeout())
+            if request_id is None: raise response
+            if request_id not in self._pending: continue # From a request we gave up on
+
+            # Responses come in order, so any earlier requests still pending were lost
+            self._pending = {i for i in self._pending if i > request_id}
+            if isinstance(response, Exception): raise response
+            return response
+
+
+    def _drain(self, collected=None):
+        """
+        Wait for the responses still in flight, so they don't carry over to the next capture.
+        Their spectra are added to collected ({integration time: list of spectra}), if given.
+        """
+        while self._pending:
+            try:
+                response = self._next_response()
+            except queue.Empty:
+                # Lost. Their responses are ignored if they turn up later.
+                self._pending.clear()
+                return
+            except Exception:
+                continue
+
+            error, integration_times, samples = response
+            if error != 0 or collected is None: continue
+            for integration_time, spectrum in zip(integration_times, samples):
+                if integration_time in collected: collected[integration_time].append(spectrum)
+
+
+    def _request_spectra(self):
         # Get 8 spectra (up to 15)
-        self.send(b'\x80\x09\x10\x00', 8)
+        if not PIPELINED:
+            self.send(GET_SPECTRA, 8)
+            return
+
+        self._request_id = (self._request_id + 1) % (1 << 32)
+        self._pending.add(self._request_id)
+        self.send(GET_SPECTRA, 8, request_id=self._request_id)
+
+
+    def _capture_sample(self):
+        """Return (integration times, spectra) from the next response."""
+        if PIPELINED:
+            # Keep the device busy: request more spectra before waiting on the current ones
+            while len(self._pending) < REQUESTS_IN_FLIGHT:
+                self._request_spectra()
 
-        # Get the response. Read packets until the checksum.
-        data = b''
-        while not data.endswith(b'\xc5\xc4\xc3\xc2'):
-            data += self.sock.recv(8192)
-        data = parse_packet(data)
+            try:
+                response = self._next_response()
+            except queue.Empty:
+                self._drain()
+                raise RuntimeError('OceanFX timed out')
+        else:
+            self._request_spectra()
+            response = parse_spectra(self._read_packet())
 
         # Check if spectrum is valid
-        error = data['error']
+        error, integration_times, samples = response
         if error != 0:
             self.reset()
             raise RuntimeError(f'OceanFX in error state {error}')
-
-        payload = data['payload']
-        segment_length = 64 + 2 * SPECTRUM_LENGTH + 4
-        n_spectra, checksum = divmod(len(payload), segment_length)
-        if checksum != 0:
-            raise RuntimeError('Invalid packet length!')
-
-        # Extract metadata, then decode
-        # from little-endian 16-byte unsigned int.
-        integration_times = []
-        samples = []
-        for i in range(n_spectra):
-            segment = payload[segment_length*i : segment_length*(i+1)]
-            metadata = segment[:64]
-            sample = np.frombuffer(segment[64:-4], dtype=np.uint16)
-
-            # Extract spectrum length and integration time.
-            spectrum_length = int.from_bytes(metadata[4:8], byteorder='little')
-            integration_time = int.from_bytes(metadata[16:20], byteorder='little')
-
-            # Return if spectrum has expected length.
-            if spectrum_length == 2 * SPECTRUM_LENGTH:
-                integration_times.append(integration_time)
-                samples.append(sample)
-
         return integration_times, samples
 
 
-    def _capture_samples(self, integration_time, time_limit=0.2):
+    def _capture_samples(self, integration_time, collected, time_limit=0.2):
+        """
+        Capture spectra at the given integration time into collected ({integration time: list of spectra}).
+        Spectra still in flight at other integration times of the sweep are kept too, rather than wasted.
+        """
         self._set_integration_time(integration_time)
 
-        # Average some spectra
         start_time = time.monotonic()
-        samples = []
         while True:
             for sample_integration_time, spectrum in zip(*self._capture_sample()):
-                if integration_time != sample_integration_time: continue
-                samples.append(spectrum)
-            if samples and time.monotonic() - start_time > time_limit: break
+                if sample_integration_time in collected: collected[sample_integration_time].append(spectrum)
+            if collected[integration_time] and time.monotonic() - start_time > time_limit: break
 
-        samples = np.array(samples)
+#        print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}Captured{Style.RESET_ALL} {Style.BRIGHT}{len(collected[integration_time])}{Style.RESET_ALL} {Style.DIM}spectra at{Style.RESET_ALL} {Style.BRIGHT}{integration_time}{Style.RESET_ALL} {Style.DIM}μs exposure.{Style.RESET_ALL}')
 
-        # Return mean + std
-#        print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}Captured{Style.RESET_ALL} {Style.BRIGHT}{len(samples)}{Style.RESET_ALL} {Style.DIM}spectra at{Style.RESET_ALL} {Style.BRIGHT}{integration_time}{Style.RESET_ALL} {Style.DIM}μs exposure.{Style.RESET_ALL}')
-        return uarray(samples.mean(axis=0), samples.std(axis=0, ddof=1))
+
+    def _average(self, samples):
+        """Return the mean and standard deviation of a list of spectra."""
+        samples = np.array(samples)
+        return UncertainArray(samples.mean(axis=0), samples.std(axis=0, ddof=1))
 
 
     def capture(self, time_limit = 1):
@@ -239,60 +476,37 @@ class OceanFX:
         # Randomize
         np.random.shuffle(integration_times)
 
-        samples = []
-        for integration_time in integration_times:
-            sample = self._capture_samples(
-                integration_time,
-                time_limit/len(integration_times)
-            )
-            samples.append(sample)
-        samples = np.array(samples).T
-
-        # Fit a linear slope at each wavelength, excluding saturated spectra.
-        points = []
-        intercepts = []
-        slopes = []
-        chisqs = []
-        for i in range(SPECTRUM_LENGTH):
-            y = samples[i]
-            mask = (nominal_values(y) + 2 * std_devs(y)) < 20000
-            y = y[mask]
-            x = integration_times[mask]
-
-            if len(y) < 4:
-                print(f'Saturated at {OCEANFX_WAVELENGTHS[i]:.2f} nm! Only {len(y)} valid points')
-
-            degree = 1
-            try:
-                std = np.maximum(std_devs(y), 20)
-                popt, pcov = np.polyfit(
-                    x, nominal_values(y), degree,
-                    w=1/std,
-                    cov=True
+        collected = {integration_time: [] for integration_time in integration_times}
+        try:
+            for integration_time in integration_times:
+                self._capture_samples(
+                    integration_time, collected,
+                    time_limit/len(integration_times)
                 )
-                perr = np.sqrt(np.diag(pcov))
-                perr[np.isinf(perr)] = 10
+        finally:
+            if PIPELINED: self._drain(collected)
+        samples = stack([self._average(collected[t]) for t in integration_times], axis=1)
+        y, y_std = samples.n, samples.s
 
-                y_pred = np.poly1d(popt)(x)
-                residuals = nominal_values(y) - y_pred
+        # Fit a linear slope at each wavelength, excluding saturated spectra.
+        mask = (y + 2 * y_std) < 20000
+        slopes, intercepts, cov, chisqs, points = fit_lines(
+            integration_times.astype(float), y,
+            np.maximum(y_std, 20), mask
+        )
 
-                dof = len(y) - degree - 1
-                chisq = np.square(residuals/std).sum()
-                chisqs.append(chisq/dof)
-            except:
-                popt = [0, 1000]
-                perr= [1000, 1000]
+        for i in np.flatnonzero(points < 4):
+            print(f'Saturated at {OCEANFX_WAVELENGTHS[i]:.2f} nm! Only {points[i]} valid points')
 
-            points.append(len(y))
-            intercepts.append(ufloat(popt[-1], perr[-1]))
-            slopes.append(ufloat(popt[-2], perr[-2]))
+        perr = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+        perr[~np.isfinite(perr)] = 10
 
 
         # Return mean + std slopes
-        self._cache = np.array(slopes)
-        self._intercepts = np.array(intercepts)
-        self._points = np.array(points)
-        self._chisqs = np.array(chisqs)
+        self._cache = UncertainArray(slopes, perr[:, 0])
+        self._intercepts = UncertainArray(intercepts, perr[:, 1])
+        self._points = points
+        self._chisqs = chisqs
 
 
     def _set_integration_time(self, val: int):
@@ -315,8 +529,8 @@ class OceanFX:
 
     @property
     def chisq(self):
-        log_chisq = np.log(self._chisqs)
-        return np.e**ufloat(np.mean(log_chisq), np.std(log_chisq))
+        log_chisq = np.log(self._chisqs) # nan for failed fits
+        return np.e**ufloat(np.nanmean(log_chisq), np.nanstd(log_chisq))
 
 
     @property
@@ -330,7 +544,7 @@ class OceanFX:
         """Return the overall percent transmission."""
         if self.sock is None: return None
 
-        return 100 * (self.intensities - self.background).sum() / self.baseline.sum()
+        return (100 * (self.intensities - self.background).sum() / self.baseline.sum()).to_ufloat()
 
 
     @property
@@ -362,3 +576,8 @@ class OceanFX:
     def roughness(self):
         """Return the estimated roughness of a transmissive surface."""
         return self.roughness_full[1]
+
+
+    ##### Context Manager Magic Methods #####
+    def __enter__(self): return self
+    def __exit__(self, exception_type, exception_value, traceback): self.close()
@@ -0,0 +1,128 @@
+"""
+Fixed-size circular buffers for live plotting.
+
+RingBuffer stores every row twice, at index i and i + capacity, so the
+last `capacity` rows are always one contiguous slice of memory. Appending
+is O(1), and view() returns them in time order without any copying or
+shifting.
+
+DecimatedBuffer keeps several RingBuffers of the same capacity. Level 0
+holds raw samples, and each level above holds block averages of `factor`
+samples from the level below. A long window can then be drawn from a
+coarse level without dropping any samples. Memory and per-sample work
+do not depend on how long the window is.
+"""
+import math
+
+import numpy as np
+
+
+class RingBuffer:
+    def __init__(self, capacity, shape=(), dtype=float, fill=np.nan):
+        self.capacity = capacity
+        self._buffer = np.full((2 * capacity, *shape), fill, dtype=dtype)
+        self._head = 0 # Index where the next row is written
+        self._count = 0
+
+    def append(self, row):
+        self._buffer[self._head] = row
+        self._buffer[self._head + self.capacity] = row
+        self._head = (self._head + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def extend(self, rows):
+        """Append several rows at once, oldest first."""
+        rows = np.asarray(rows)[-self.capacity:]
+        index = (self._head + np.arange(len(rows))) % self.capacity
+        self._buffer[index] = rows
+        self._buffer[index + self.capacity] = rows
+        self._head = (self._head + len(rows)) % self.capacity
+        self._count = min(self._count + len(rows), self.capacity)
+
+    def view(self):
+        """Return the last `capacity` rows, oldest first. Unfilled rows are at the start."""
+        return self._buffer[self._head:self._head + self.capacity]
+
+    def filled(self):
+        """Return only the rows written so far, oldest first."""
+        return self.view()[self.capacity - self._count:]
+
+    def __len__(self): return self._count
+
+
+
+class DecimatedBuffer:
+    """
+    Ring buffers of (time, row) samples at decimation factors 1, factor, factor^2, ...
+    NaNs in a row are ignored when averaging.
+    """
+
+    def __init__(self, capacity, shape=(), levels=1, factor=4):
+        self.capacity = capacity
+        self.factor = factor
+
+        self.times = [RingBuffer(capacity) for _ in range(levels)]
+        self.data = [RingBuffer(capacity, shape) for _ in range(levels)]
+
+        # Running sums for the block being averaged into each level above 0
+        self._time_sum = np.zeros(levels)
+        self._sum = np.zeros((levels, *shape))
+        self._count = np.zeros((levels, *shape), dtype=int)
+        self._n = np.zeros(levels, dtype=int)
+
+    @classmethod
+    def for_window(cls, capacity, samples, shape=(), factor=4):
+        """Create a buffer with enough levels that the coarsest one covers `samples` raw samples."""
+        levels = 1
+        if samples > capacity: levels += math.ceil(math.log(samples / capacity, factor))
+        return cls(capacity, shape, levels=levels, factor=factor)
+
+    @property
+    def levels(self): return len(self.times)
+
+    def append(self, timestamp, row):
+        row = np.asarray(row, dtype=float)
+        self._push(0, timestamp, row)
+
+    def _push(self, level, timestamp, row):
+        self.times[level].append(timestamp)
+        self.data[level].append(row)
+
+        above = level + 1
+        if above >= self.levels: return
+
+        valid = ~np.isnan(row)
+        self._time_sum[above] += timestamp
+        self._sum[above] += np.where(valid, row, 0)
+        self._count[above] += valid
+        self._n[above] += 1
+
+        if self._n[above] == self.factor:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                average = self._sum[above] / self._count[above]
+            timestamp = self._time_sum[above] / self.factor
+
+            self._time_sum[above] = 0
+            self._sum[above] = 0
+            self._count[above] = 0
+            self._n[above] = 0
+
+            self._push(above, timestamp, average)
+
+    def level_for(self, span):
+        """Return the finest level whose capacity covers `span` (same units as the timestamps)."""
+        for level in range(self.levels):
+            times = self.times[level].filled()
+            if len(times) < self.capacity: return level # Not full yet, so holds everything so far
+            if times[-1] - times[0] >= span: return level
+        return self.levels - 1
+
+    def view(self, level):
+        """Return (times, data) written so far at the given level, oldest first."""
+        return self.times[level].filled(), self.data[level].filled()
+
+    def window(self, span):
+        """Return (times, data) covering the last `span`, from the finest level that holds all of it."""
+        times, data = self.view(self.level_for(span))
+        start = np.searchsorted(times, times[-1] - span) if len(times) else 0
+        return times[start:], data[start:]
@@ -0,0 +1,110 @@
+"""
+Runs functions in separate processes, restarting them when they die or hang.
+
+Each process updates a heartbeat from a background thread. If a process exits,
+or its heartbeat stops (e.g. it is stuck holding the GIL in an extension), it is
+restarted after a short random delay. Processes are started with 'spawn', so
+targets must be importable module-level functions (or partials of them).
+"""
+import time, random, threading, traceback
+import multiprocessing
+
+import psutil
+from colorama import Fore, Style
+
+
+HEARTBEAT_INTERVAL = 1 # s
+CHECK_INTERVAL = 1 # s
+
+
+def _run(target, heartbeat):
+    def beat():
+        while True:
+            heartbeat.value = time.time()
+            time.sleep(HEARTBEAT_INTERVAL)
+    threading.Thread(target=beat, daemon=True).start()
+    target()
+
+
+class Supervisor:
+    def __init__(self, targets, heartbeat_timeout=30, restart_delay=lambda: 10 + 3 * random.random()):
+        """
+        targets: dict of name -> function to run in its own process.
+        heartbeat_timeout: seconds without a heartbeat before a process is killed and restarted.
+        restart_delay: function returning how long to wait before restarting a process.
+        """
+        self._targets = targets
+        self._heartbeat_timeout = heartbeat_timeout
+        self._restart_delay = restart_delay
+        self._context = multiprocessing.get_context('spawn')
+
+        self._processes = {}
+        self._heartbeats = {}
+        self._stats = {}
+        self._restart_at = {} # name -> time.monotonic() to restart at
+        self.restarts = {name: 0 for name in targets.keys()}
+
+    def start(self):
+        for name in self._targets.keys(): self._spawn(name)
+        threading.Thread(target=self._monitor, name='supervisor', daemon=True).start()
+
+    def _spawn(self, name):
+        print(f'Starting {Style.BRIGHT}{name}{Style.RESET_ALL} process')
+        heartbeat = self._context.Value('d', time.time())
+        process = self._context.Process(target=_run, args=(self._targets[name], heartbeat), name=name, daemon=True)
+        process.start()
+
+        self._processes[name] = process
+        self._heartbeats[name] = heartbeat
+        self._stats[name] = psutil.Process(process.pid)
+
+    def _monitor(self):
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            try:
+                self._check()
+            except Exception:
+                traceback.print_exc()
+
+    def _check(self):
+        now = time.monotonic()
+        for name, process in self._processes.items():
+            if name in self._restart_at:
+                if now >= self._restart_at[name]:
+                    del self._restart_at[name]
+                    self.restarts[name] += 1
+                    self._spawn(name)
+                continue
+
+            if not process.is_alive():
+                reason = f'exited with code {process.exitcode}'
+            elif time.time() - self._heartbeats[name].value > self._heartbeat_timeout:
+                reason = 'stopped responding'
+                process.kill()
+                process.join(timeout=5)
+            else:
+                continue
+
+            delay = self._restart_delay()
+            print(f'{Fore.RED}{name} process {reason}!{Style.RESET_ALL} Restarting after {delay:.2f} seconds...')
+            self._restart_at[name] = now + delay
+
+    def stats(self):
+        """Return {name: {alive, cpu [%], memory [KB], heartbeat [s ago], restarts}} of each process."""
+        stats = {}
+        for name, process in list(self._processes.items()):
+            alive = process.is_alive()
+            try:
+                cpu = self._stats[name].cpu_percent() if alive else None
+                memory = round(self._stats[name].memory_info().rss / 1024) if alive else None
+            except psutil.Error:
+                cpu, memory = None, None
+
+            stats[name] = {
+                'alive': alive,
+                'cpu': cpu,
+                'memory': memory,
+                'heartbeat': time.time() - self._heartbeats[name].value,
+                'restarts': self.restarts[name],
+            }
+        return stats
@@ -57,14 +57,13 @@ class TiSapphire:
         """Read usb4000 thread until last entry."""
         start = time.monotonic()
         while True:
-            ts, data = self._spec_conn.grab_json_data()
+            ts, data = self._spec_conn.latest()
             if data is not None:
                 self._cache = (time.time(), data)
-            else:
-                if self._cache is not None:
-                    break
-                if time.monotonic() - start > 1:
-                    raise ValueError('USB4000 Thread Unreachable!')
+            if self._cache is not None:
+                break
+            if time.monotonic() - start > 1:
+                raise ValueError('USB4000 Thread Unreachable!')
             time.sleep(0.02)
             
 
@@ -0,0 +1,106 @@
+"""
+Lightweight arrays of values with uncertainties.
+
+uncertainties.unumpy.uarray creates one Python object per element and
+tracks correlations between all of them, which is slow and memory hungry
+for whole spectra. UncertainArray instead stores nominal values and
+standard deviations as two float arrays, and propagates errors with
+vectorized formulas, treating all operands as independent.
+
+Convert to ufloat only where a single number is published:
+    transmission = (100 * (intensities - background).sum() / baseline.sum()).to_ufloat()
+"""
+import numpy as np
+
+from uncertainties import ufloat
+
+
+class UncertainArray:
+    __array_ufunc__ = None # Make numpy defer to the reflected operators below
+
+    def __init__(self, n, s=0):
+        self.n = np.asarray(n, dtype=float)
+        self.s = np.broadcast_to(np.asarray(s, dtype=float), self.n.shape).copy()
+
+    @classmethod
+    def from_uarray(cls, arr):
+        import uncertainties.unumpy as unp
+        return cls(unp.nominal_values(arr), unp.std_devs(arr))
+
+    def to_uarray(self):
+        import uncertainties.unumpy as unp
+        return unp.uarray(self.n, self.s)
+
+    def to_ufloat(self):
+        """Return a single ufloat. The array must have exactly one element."""
+        return ufloat(self.n.item(), self.s.item())
+
+
+    ##### Array Interface #####
+    @property
+    def shape(self): return self.n.shape
+
+    def __len__(self): return len(self.n)
+
+    def __getitem__(self, key): return UncertainArray(self.n[key], self.s[key])
+
+    def __repr__(self): return f'UncertainArray(n={self.n!r}, s={self.s!r})'
+
+
+    ##### Arithmetic #####
+    def __neg__(self): return UncertainArray(-self.n, self.s)
+
+    def __add__(self, other):
+        n, s = _parts(other)
+        return UncertainArray(self.n + n, np.hypot(self.s, s))
+
+    def __sub__(self, other):
+        n, s = _parts(other)
+        return UncertainArray(self.n - n, np.hypot(self.s, s))
+
+    def __mul__(self, other):
+        n, s = _parts(other)
+        return UncertainArray(self.n * n, np.hypot(self.s * n, s * self.n))
+
+    def __truediv__(self, other):
+        n, s = _parts(other)
+        return UncertainArray(self.n / n, np.hypot(self.s / n, s * self.n / n**2))
+
+    def __pow__(self, power):
+        return UncertainArray(self.n ** power, np.abs(power * self.n ** (power - 1)) * self.s)
+
+    def __radd__(self, other): return self + other
+    def __rsub__(self, other): return -self + other
+    def __rmul__(self, other): return self * other
+    def __rtruediv__(self, other): return UncertainArray(*_parts(other)) / self
+
+
+    ##### Reductions #####
+    def sum(self, axis=None):
+        return UncertainArray(self.n.sum(axis=axis), np.sqrt(np.square(self.s).sum(axis=axis)))
+
+    def mean(self, axis=None):
+        count = self.n.size if axis is None else self.n.shape[axis]
+        return self.sum(axis=axis) / count
+
+
+def _parts(x):
+    """Return (nominal, std) of an UncertainArray, ufloat, or plain number/array."""
+    if isinstance(x, UncertainArray): return x.n, x.s
+    if hasattr(x, 'nominal_value'): return x.nominal_value, x.std_dev
+    return np.asarray(x, dtype=float), 0
+
+
+##### Functions #####
+def log(x):
+    return UncertainArray(np.log(x.n), x.s / np.abs(x.n))
+
+def exp(x):
+    value = np.exp(x.n)
+    return UncertainArray(value, value * x.s)
+
+def stack(arrays, axis=0):
+    return UncertainArray(
+        np.stack([x.n for x in arrays], axis=axis),
+        np.stack([x.s for x in arrays], axis=axis),
+    )
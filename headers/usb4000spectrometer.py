@@ -30,7 +30,7 @@ class USB4000Spectrometer(USBTMCDevice):
 
         while True:
             start_time = time.monotonic()
-            response = self.query(f'INTENSITIES')
+            response = self.query_binary('INTENSITIES BINARY')
             if not fresh_sample: break
 
             # Ensure we get a fresh capture
@@ -38,7 +38,7 @@ class USB4000Spectrometer(USBTMCDevice):
             print('Skipping cached spectrum')
             time.sleep(0.5)
 
-        self._intensities = np.array([float(x) for x in response.split()])[GARBAGE_POINTS:]
+        self._intensities = np.frombuffer(response, dtype='<f4')[GARBAGE_POINTS:].astype(float)
         self._capture_time = time.time()
 
     def async_capture(self, fresh_sample=False):
@@ -62,8 +62,8 @@ class USB4000Spectrometer(USBTMCDevice):
     @property
     def wavelengths(self):
         if self._wavelengths is None:
-            response = self.query(f'WAVELENGTHS')
-            self._wavelengths = np.array([float(x) for x in response.split()])[GARBAGE_POINTS:]
+            response = self.query_binary('WAVELENGTHS BINARY')
+            self._wavelengths = np.frombuffer(response, dtype='<f4')[GARBAGE_POINTS:].astype(float)
         return self._wavelengths
 
     @property
@@ -1,5 +1,5 @@
 from typing import Optional, Literal, Union
-import serial, time, telnetlib, itertools, os, socket, select, traceback
+import serial, time, telnetlib, itertools, os, socket, select, traceback, re
 
 import asyncio
 from colorama import Fore, Style
@@ -11,6 +11,29 @@ DEBUG = False # Whether to print commands as they are sent
 DRY_RUN = False # If true, nothing actually happens (useful for debug)
 
 
+##### Multiplexer Framing #####
+# In multiplexed mode, each request is one line, `query <command>` or `send <command>`,
+# and the multiplexer answers each with one line: `+<response>` or `-<error>`.
+# Backslashes and newlines are escaped, so arbitrary bytes fit on one line.
+#
+# For bulk data, `binary <command>` is answered with `#<length>` on one line,
+# followed by exactly that many raw bytes (or with `-<error>`).
+def escape_line(data: bytes) -> bytes:
+    return data.replace(b'\\', b'\\\\').replace(b'\n', b'\\n')
+
+def unescape_line(line: bytes) -> bytes:
+    return re.sub(rb'\\(.)', lambda m: b'\n' if m.group(1) == b'n' else m.group(1), line, flags=re.S)
+
+def frame_request(kind: bytes, command: bytes) -> bytes:
+    return kind + b' ' + escape_line(command) + b'\n'
+
+def unframe_response(line: bytes) -> bytes:
+    line = line.rstrip(b'\n')
+    if line[:1] != b'+':
+        raise ValueError(f'Multiplexer error: {unescape_line(line[1:]).decode("utf-8", "replace")}')
+    return unescape_line(line[1:])
+
+
 class USBTMCDevice:
     """The currently open connection."""
     _conn = None
@@ -85,6 +108,8 @@ class USBTMCDevice:
         if self._mode == 'multiplexed':
             # For async: defer connection until later.
             self._async_conn = None
+            self._async_lock = None
+            self._line_buffer = b''
             self._address = ('127.0.0.1', self._resource_path)
 
             try:
@@ -110,11 +135,12 @@ class USBTMCDevice:
         Subclasses may override this to add additional cleanup behavior.
         """
         if self._mode == 'multiplexed':
-            self._conn.send(b'unlock')
-
+            # Framed requests hold no lock on the multiplexer, so there is nothing to release
             if self._async_conn is not None:
                 reader, writer = self._async_conn
                 writer.close()
+                self._async_conn = None
+            if self._conn is None: return
 
         self._conn.close()
 
@@ -145,12 +171,8 @@ class USBTMCDevice:
             command = (command + '\n').encode('utf-8')
 
         if self._mode == 'multiplexed':
-            self._conn.send(command)
-
-            # unless you read after, a 0.2 s
-            # delay is necessary because of
-            # TCP packet scheduling voodoo magic
-            time.sleep(delay)
+            # Wait for the multiplexer to confirm the command was passed on. No fixed delay needed.
+            self._request(b'send', command)
             return
 
         self._clear_output()
@@ -180,6 +202,7 @@ class USBTMCDevice:
         delay: float
             Delay between writing the command and reading the response.
             Increase the delay for commands that return large amounts of data.
+            Not used in multiplexed mode, where the multiplexer waits for the response.
         """
         if DRY_RUN:
             self.send_command(command, raw=raw_command, delay=0)
@@ -210,33 +233,10 @@ class USBTMCDevice:
             response = self._conn.readline()
 
         if self._mode == 'multiplexed':
-            # Acquire lock
-            self._conn.send(b'lock\n')
-            assert self._conn.recv(32) == b'locked'
-
-            # Send command and wait for device response
-            self.send_command(command, raw=raw_command, delay=delay)
-
-            # Read response
-            for i in range(20):
-                self._conn.send(b'read\n')
-                response = self._conn.recv(65536)
-                if response != b'read failed': break
-                time.sleep(5e-2)
-                if DEBUG:
-                    print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} :{Style.RESET_ALL} {Fore.BLUE}Read failed, trying again.{Style.RESET_ALL}')
-            else:
-                raise ValueError('Read failed too many times.')
-
-            # Release lock
-            time.sleep(1e-3)
-            self._conn.send(b'unlock\n')
-            try:
-                assert self._conn.recv(32) == b'unlocked'
-            except (AssertionError, socket.timeout):
-                # Force close connection if failed to unlock
-                self.close()
-                self.connect()
+            # The multiplexer writes the command and waits for the response atomically.
+            if not raw_command: command = command.encode('utf-8')
+            if DEBUG: print(f'  [{Fore.RED}SEND{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} <{Style.RESET_ALL} {Fore.RED}{command}{Style.RESET_ALL}')
+            response = self._request(b'query', command)
 
         if DEBUG: print(f'  [{Fore.GREEN}RECV{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} >{Style.RESET_ALL} {Fore.GREEN}{response[:50]}{Style.RESET_ALL}')
 
@@ -249,67 +249,128 @@ class USBTMCDevice:
 
 
 
+    def _request(self, kind: bytes, command: bytes) -> bytes:
+        """Send one framed request to the multiplexer, and return the response."""
+        # Reconnect if the multiplexer was down last time
+        if self._conn is None: self.connect()
+        if self._conn is None: raise ConnectionError('Multiplexer not available')
+
+        try:
+            self._conn.sendall(frame_request(kind, command.rstrip(b'\n')))
+            line = self._recv_line()
+            if line[:1] == b'#': return self._recv_exactly(int(line[1:]))
+        except (socket.timeout, ConnectionError):
+            # Drop the connection, so a late response can't be mistaken for the next one
+            self._line_buffer = b''
+            self._conn.close()
+            self.connect()
+            raise
+
+        return unframe_response(line)
+
+    def _recv_line(self) -> bytes:
+        while b'\n' not in self._line_buffer:
+            data = self._conn.recv(65536)
+            if not data: raise ConnectionError('Multiplexer closed the connection')
+            self._line_buffer += data
+
+        line, self._line_buffer = self._line_buffer.split(b'\n', 1)
+        return line
+
+    def _recv_exactly(self, length: int) -> bytes:
+        chunks, received = [self._line_buffer], len(self._line_buffer)
+        while received < length:
+            data = self._conn.recv(max(length - received, 65536))
+            if not data: raise ConnectionError('Multiplexer closed the connection')
+            chunks.append(data)
+            received += len(data)
+
+        data = b''.join(chunks)
+        self._line_buffer = data[length:]
+        return data[:length]
+
+
+    def query_binary(self, command: str) -> bytes:
+        """
+        Send a command to the device through the multiplexer, and return its
+        response as a length-prefixed binary block. For bulk data like spectra.
+        """
+        assert self._mode == 'multiplexed'
+        if DEBUG: print(f'  [{Fore.RED}SEND{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} <{Style.RESET_ALL} {Fore.RED}{command}{Style.RESET_ALL}')
+        if DRY_RUN: return None
+        return self._request(b'binary', command.encode('utf-8'))
+
+
     ##### Async Code #####
     async def open_async_connection(self):
         """Open a new async TCP connection, if not already opened."""
         assert self._mode == 'multiplexed'
         if self._async_conn is not None: return
-        self._async_conn = await asyncio.open_connection(*self._address)
+        self._async_conn = await asyncio.open_connection(*self._address, limit=1 << 24)
+
+
+    async def _arequest(self, kind: bytes, command: bytes) -> bytes:
+        # One request at a time per connection, so responses can't get mixed up
+        if self._async_lock is None: self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            await self.open_async_connection()
+            reader, writer = self._async_conn
+
+            try:
+                writer.write(frame_request(kind, command.rstrip(b'\n')))
+                await writer.drain()
+                line = await asyncio.wait_for(reader.readline(), timeout=self._timeout)
+                if line[:1] == b'#':
+                    return await asyncio.wait_for(reader.readexactly(int(line[1:])), timeout=self._timeout)
+                if not line: raise ConnectionError('Multiplexer closed the connection')
+            except BaseException:
+                # Drop the connection (also on timeout or cancellation), so a late response can't be mistaken for the next one
+                writer.close()
+                self._async_conn = None
+                raise
+
+        return unframe_response(line)
+
+
+    async def asend(self, command: str, raw_command: bool = False) -> None:
+        """Send a command to the device, returning once the multiplexer has passed it on."""
+        if DEBUG: print(f'  [{Fore.RED}SEND{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} <{Style.RESET_ALL} {Fore.RED}{command}{Style.RESET_ALL}')
+        if DRY_RUN: return
 
+        if not raw_command: command = command.encode('utf-8')
+        await self._arequest(b'send', command)
 
-    async def async_query(
+
+    async def aquery(
             self,
             command: str,
             raw: bool = False,
             raw_command: bool = False,
-            delay: float = 2e-2
         ) -> Union[str, bytes]:
-
-        await self.open_async_connection()
-        reader, writer = self._async_conn
-
-        # Acquire lock
-        writer.write(b'lock\n')
-        await writer.drain()
-        assert await reader.read(32) == b'locked'
-
-        # Send command and wait for device response
+        """Send a command to the device, and return its response."""
         if DEBUG: print(f'  [{Fore.RED}SEND{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} <{Style.RESET_ALL} {Fore.RED}{command}{Style.RESET_ALL}')
-        if not raw_command:
-            command = (command + '\n').encode('utf-8')
-        writer.write(command)
-        await writer.drain()
-        await asyncio.sleep(delay)
-
-        # Read response
-        for i in range(20):
-            writer.write(b'read\n')
-            await writer.drain()
-
-            response = await reader.read(1024)
-            if response != b'read failed': break
-            await asyncio.sleep(5e-2)
-            print(f'  [{Fore.BLUE}INFO{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} :{Style.RESET_ALL} {Fore.BLUE}Read failed, trying again.{Style.RESET_ALL}')
-        else:
-            raise ValueError('Read failed too many times.')
+        if DRY_RUN: return None
 
-        if DEBUG: print(f'  [{Fore.GREEN}RECV{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} >{Style.RESET_ALL} {Fore.GREEN}{response[:50]}{Style.RESET_ALL}')
+        if not raw_command: command = command.encode('utf-8')
+        response = await self._arequest(b'query', command)
 
-        # Release lock
-        await asyncio.sleep(1e-3)
-        writer.write(b'unlock\n')
-        await writer.drain()
-        await asyncio.sleep(2e-3)
-        ack = await asyncio.wait_for(
-            reader.read(32),
-            timeout=5
-        )
-        assert ack == b'unlocked'
+        if DEBUG: print(f'  [{Fore.GREEN}RECV{Style.RESET_ALL}] {Style.DIM}{self.short_name:20s} >{Style.RESET_ALL} {Fore.GREEN}{response[:50]}{Style.RESET_ALL}')
 
         # Decode the response to a Python string if raw == False.
         return response if raw else response.decode('utf-8').strip()
 
 
+    async def aquery_binary(self, command: str) -> bytes:
+        """Async version of query_binary."""
+        if DRY_RUN: return None
+        return await self._arequest(b'binary', command.encode('utf-8'))
+
+
+    async def async_query(self, command, raw=False, raw_command=False, delay=None):
+        """Deprecated alias of aquery. `delay` is no longer needed."""
+        return await self.aquery(command, raw=raw, raw_command=raw_command)
+
+
 
 
 
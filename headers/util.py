@@ -17,12 +17,23 @@ from scipy.special import chdtrc as chisqcdf
 from uncertainties import ufloat, correlated_values
 from uncertainties import unumpy as unp
 
+try:
+    from headers.uncertain_array import UncertainArray
+except:
+    from uncertain_array import UncertainArray
+
 from colorama import Fore, Back, Style, init
 init(strip=False)
 
 
-nom = unp.nominal_values
-std = unp.std_devs
+def nom(x):
+    if isinstance(x, UncertainArray): return x.n
+    return unp.nominal_values(x)
+
+def std(x):
+    if isinstance(x, UncertainArray): return x.s
+    return unp.std_devs(x)
+
 uarray = unp.uarray
 
 
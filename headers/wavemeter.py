@@ -39,6 +39,8 @@ import time
 import ctypes
 import zmq
 import sys
+import ast
+import math
 
 
     
@@ -47,6 +49,7 @@ import sys
 class WM:
     def __init__(self, mode='client', port=9000):
         self.mode = mode
+        self._batch_supported = True
         
         if mode == 'server':
             self.dll = LoadDLL()
@@ -99,6 +102,55 @@ class WM:
         return [self.read_laser_power(i+1) for i in range(8)]
         
         
+    # Methods that read_many may call. All are read-only.
+    _batch_methods = {
+        'read_frequency', 'read_wavelength', 'read_temperature', 'read_laser_power',
+        'read_linewidth', 'read_exposure', 'get_external_output',
+    }
+
+    @_mode_check
+    def _read_many(self, requests):
+        results = []
+        for method, *args in requests:
+            try:
+                assert method in self._batch_methods, f'{method} cannot be batched'
+                value = float(getattr(self, method)(*args))
+                results.append(value if math.isfinite(value) else None)
+            except Exception:
+                results.append(None)
+        return results
+
+    def read_many(self, requests):
+        """
+        Perform several reads in one request to the wavemeter server.
+
+        requests: list of (method name, *args), e.g. [('read_temperature',), ('read_frequency', 6)].
+        Returns the results in the same order, with None for any read that failed.
+
+        The server must be running a version of this file with _read_many.
+        Otherwise, this falls back to one request per read.
+        """
+        requests = [tuple(r) for r in requests]
+        if self._batch_supported:
+            results = self._read_many(requests)
+            try:
+                if isinstance(results, str): results = ast.literal_eval(results)
+                assert isinstance(results, list) and len(results) == len(requests)
+                return results
+            except Exception:
+                print(f'Wavemeter server cannot batch reads ({results!r}). Reading individually.')
+                self._batch_supported = False
+
+        results = []
+        for method, *args in requests:
+            try:
+                value = float(getattr(self, method)(*args))
+                results.append(value if math.isfinite(value) else None)
+            except Exception:
+                results.append(None)
+        return results
+
+
     @_mode_check    
     def read_frequency(self,channel):
         """ Return frequency of channel in GHz """
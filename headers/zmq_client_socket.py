@@ -5,19 +5,28 @@ Created by James Park and Mohit Verma.
 """
 import os
 import zmq
-import ast
 import time
 
 import hashlib
 
+try:
+    from headers.zmq_codec import unpack_message
+except:
+    from zmq_codec import unpack_message
 
-def connect_to(topic):
+
+def connect_to(topic, latest_only=False, inproc=False):
     # Quick connect to localhost, on auto-assigned port.
+    # If latest_only is set, grab_json_data() skips straight to the newest message.
+    # If inproc is set, connect in-process instead (the server must be in this process,
+    # with zmq_server_socket.use_inproc() enabled).
     port = int.from_bytes(hashlib.md5(topic.encode()).digest(), 'big') % 40000 + 10000
     socket = zmq_client_socket({
         'ip_addr': 'localhost',
         'port': port,
         'topic': topic,
+        'latest_only': latest_only,
+        'inproc': inproc,
     })
     return socket
 
@@ -38,26 +47,60 @@ class zmq_client_socket:
         @type settings: String
         @rtype: None
         """
-        self.zmq_context = zmq.Context() #initialize zmq 
+        self.load_settings(connection_settings)
+        # In-process sockets must share the server's context
+        inproc = connection_settings.get('inproc', False)
+        self.zmq_context = zmq.Context.instance() if inproc else zmq.Context() #initialize zmq 
         self.made_socket = False
         self.received_first_data = False
-        self.load_settings(connection_settings)
         self.make_connection()
         self.current_data = self.grab_data()
 
-        print('Connected to', connection_settings['topic'], 'on port', connection_settings['port'])
+        print('Connected to', connection_settings['topic'], 'in-process' if inproc else f'on port {connection_settings["port"]}')
 
     def flush(self):
         """Clear all data in buffer."""
-        while True:
-            _, data = self.grab_json_data()
-            if data is None: break
+        self._drain()
 
 
     def grab_json_data(self):
+        if self.connection_settings.get('latest_only', False):
+            return self.latest()
+
         data = self.grab_data()
         if data is None: return (None, None)
         return self._decode(data)
+
+
+    def latest(self):
+        """
+        Returns the newest message in the queue, discarding older ones.
+        Only the newest message is decoded, so this is cheap even if
+        many messages have piled up. Returns (None, None) if the queue
+        is empty.
+        
+        (ZMQ_CONFLATE would do this inside zmq, but does not support
+        the multipart messages used by the binary formats.)
+        
+        @type self: zmq_client_socket
+        @rtype: Tuple
+        """
+        data = self._drain()
+        if data is None: return (None, None)
+        return self._decode(data)
+
+
+    def _drain(self):
+        """Receive every queued message without decoding. Return the last one, or None."""
+        assert self.made_socket
+        last = None
+        while True:
+            try:
+                last = self.socket.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+            except zmq.ZMQError:
+                break
+            self.received_first_data = True
+        return last
         
                 
     def grab_data(self):
@@ -74,23 +117,22 @@ class zmq_client_socket:
         """
         assert self.made_socket
         try:
-            received_data = self.socket.recv(flags=zmq.NOBLOCK)
+            received_data = self.socket.recv_multipart(flags=zmq.NOBLOCK, copy=False)
             self.received_first_data = True
             return received_data
         except zmq.ZMQError:
             return
 
     def _decode(self, packet):
-        out = packet.decode("utf-8").split(' ')
-        topic, time = out[:2]
-        messagedata = ast.literal_eval(' '.join(out[2:]))
-        timestamp = float(time)
+        """Decode a message (list of frames, or a legacy single-frame bytes string)."""
+        if isinstance(packet, bytes): packet = [packet]
+        _, timestamp, messagedata = unpack_message(packet)
         return (timestamp, messagedata)
 
 
     def blocking_read(self):
         assert self.made_socket
-        return self._decode(self.socket.recv())
+        return self._decode(self.socket.recv_multipart(copy=False))
 
             
     def read_on_demand(self):
@@ -106,11 +148,11 @@ class zmq_client_socket:
         @rtype: None
         """
         try:
-            string = self.socket.recv(flags=zmq.NOBLOCK)
+            frames = self.socket.recv_multipart(flags=zmq.NOBLOCK, copy=False)
         except zmq.ZMQError:
             return None
 
-        return self._decode(string)
+        return self._decode(frames)
 
 
     def load_settings(self, connection_settings):
@@ -124,6 +166,8 @@ class zmq_client_socket:
         @type ip_addr: String
         @type port: Integer
         @type topic: String
+        @type latest_only: Boolean (optional)
+        @type inproc: Boolean (optional)
         @rtype: None
         """
         self.connection_settings = connection_settings
@@ -140,8 +184,11 @@ class zmq_client_socket:
             self.made_socket = True
         self.socket = self.zmq_context.socket(zmq.SUB)  #initialized to be a zmq client socket
         #connection settings to the ip address and port.
-        connection_string = "tcp://%s:%s" % (self.connection_settings['ip_addr'],
-                                          self.connection_settings['port'])
+        if self.connection_settings.get('inproc', False):
+            connection_string = "inproc://%s" % self.connection_settings['topic']
+        else:
+            connection_string = "tcp://%s:%s" % (self.connection_settings['ip_addr'],
+                                              self.connection_settings['port'])
         self.socket.connect(connection_string)
         self.socket.setsockopt(zmq.SUBSCRIBE, self.connection_settings['topic'].encode())
         
@@ -0,0 +1,233 @@
+"""
+Wire formats for zmq_server_socket and zmq_client_socket.
+
+Two framings are understood by the client:
+
+  - text (legacy): a single frame `"<topic> <timestamp> <repr(data)>"`,
+    parsed back with ast.literal_eval. Old clients only understand this.
+
+  - binary: a multipart message `[b"<topic> <timestamp> <codec>", body, *buffers]`.
+    The body is produced by the named codec, and large payloads (numpy arrays,
+    PNG bytes) travel as separate out-of-band frames instead of being
+    escaped into the body. Arrays are described by a small dtype/shape
+    header, sent straight from their own memory and reconstructed on the
+    client as np.frombuffer views of the received frame, so no
+    per-element Python objects are created on either side.
+
+The publisher picks the codec for each topic (see TOPIC_CODECS), and since
+the codec name rides in the header frame, new clients decode either format
+without any configuration.
+"""
+import ast
+
+import numpy as np
+
+import msgpack
+
+
+##### Codecs #####
+class TextCodec:
+    """Legacy repr + ast.literal_eval format. Slow, but readable by old clients."""
+    name = 'text'
+
+    def encode(self, data):
+        return repr(_to_builtin(data)).encode('utf-8'), []
+
+    def decode(self, body, buffers):
+        return ast.literal_eval(bytes(body).decode('utf-8'))
+
+
+# msgpack extension type codes
+EXT_TUPLE = 1
+EXT_NDARRAY = 2
+EXT_BYTES = 3
+
+# Byte strings at least this long are sent as their own frame.
+OUT_OF_BAND_THRESHOLD = 1024
+
+class MsgpackCodec:
+    """
+    msgpack body, with numpy arrays and large byte strings sent out-of-band.
+    Tuples are preserved, so (value, uncertainty) pairs survive the round trip.
+    """
+    name = 'msgpack'
+
+    def encode(self, data):
+        buffers = []
+        body = msgpack.packb(self._pack(data, buffers))
+        return body, buffers
+
+    def _pack(self, obj, buffers):
+        if isinstance(obj, dict):
+            return {key: self._pack(value, buffers) for key, value in obj.items()}
+
+        if isinstance(obj, list):
+            return [self._pack(value, buffers) for value in obj]
+
+        if isinstance(obj, tuple):
+            content = [self._pack(value, buffers) for value in obj]
+            return msgpack.ExtType(EXT_TUPLE, msgpack.packb(content))
+
+        if isinstance(obj, np.ndarray):
+            if obj.dtype.hasobject: return self._pack(obj.tolist(), buffers)
+            buffers.append(np.ascontiguousarray(obj))
+            header = [obj.dtype.str, list(obj.shape), len(buffers) - 1]
+            return msgpack.ExtType(EXT_NDARRAY, msgpack.packb(header))
+
+        if isinstance(obj, (bytes, bytearray)) and len(obj) >= OUT_OF_BAND_THRESHOLD:
+            buffers.append(obj)
+            return msgpack.ExtType(EXT_BYTES, msgpack.packb(len(buffers) - 1))
+
+        if isinstance(obj, np.generic):
+            return obj.item()
+
+        return obj
+
+    def decode(self, body, buffers):
+        def ext_hook(code, content):
+            if code == EXT_TUPLE:
+                return tuple(msgpack.unpackb(
+                    content, ext_hook=ext_hook,
+                    raw=False, strict_map_key=False
+                ))
+
+            if code == EXT_NDARRAY:
+                dtype, shape, index = msgpack.unpackb(content)
+                return np.frombuffer(buffers[index], dtype=dtype).reshape(shape)
+
+            if code == EXT_BYTES:
+                return bytes(buffers[msgpack.unpackb(content)])
+
+            return msgpack.ExtType(code, content)
+
+        return msgpack.unpackb(body, ext_hook=ext_hook, raw=False, strict_map_key=False)
+
+
+def _to_builtin(obj):
+    """Convert numpy types to plain Python types, so that repr() can be literal_eval'd."""
+    if isinstance(obj, dict): return {key: _to_builtin(value) for key, value in obj.items()}
+    if isinstance(obj, list): return [_to_builtin(value) for value in obj]
+    if isinstance(obj, tuple): return tuple(_to_builtin(value) for value in obj)
+    if isinstance(obj, np.ndarray): return obj.tolist()
+    if isinstance(obj, np.generic): return obj.item()
+    return obj
+
+
+
+##### Codec Registry #####
+CODECS = {}
+
+def register_codec(codec):
+    """Make a codec available to servers and clients by its name."""
+    CODECS[codec.name] = codec
+
+# No pickle: servers bind on all interfaces, and unpickling a message from
+# anyone who can publish to a port would let them run code on every client.
+register_codec(TextCodec())
+register_codec(MsgpackCodec())
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f'Unknown codec {name!r}. Available codecs: {", ".join(CODECS)}')
+
+
+BINARY_CODEC = 'msgpack'
+
+# Codec used by topics not listed in TOPIC_CODECS.
+DEFAULT_CODEC = 'text'
+
+# Topics carrying images or full spectra, which benefit most from a binary format.
+TOPIC_CODECS = {
+    'plume-cam': BINARY_CODEC,
+    'webcam': BINARY_CODEC,
+    'fringe-cam': BINARY_CODEC,
+    'spectrometer': BINARY_CODEC,
+    'scope': BINARY_CODEC,
+}
+
+def codec_for_topic(topic):
+    return TOPIC_CODECS.get(topic, DEFAULT_CODEC)
+
+
+
+##### Framing #####
+def pack_message(topic, timestamp, data, codec):
+    """Return the list of frames for one message."""
+    body, buffers = codec.encode(data)
+
+    if codec.name == 'text':
+        return [f'{topic} {timestamp:f} '.encode('utf-8') + body]
+
+    header = f'{topic} {timestamp:f} {codec.name}'.encode('utf-8')
+    return [header, body, *buffers]
+
+
+def unpack_message(frames):
+    """
+    Decode a list of frames (bytes or zmq.Frame) into (topic, timestamp, data).
+    Arrays in the result are views into the frames, not copies.
+    """
+    frames = [memoryview(frame) for frame in frames]
+
+    if len(frames) == 1:
+        topic, timestamp, body = bytes(frames[0]).decode('utf-8').split(' ', 2)
+        return topic, float(timestamp), ast.literal_eval(body)
+
+    topic, timestamp, codec_name = bytes(frames[0]).decode('utf-8').split(' ')
+    data = get_codec(codec_name).decode(frames[1], frames[2:])
+    return topic, float(timestamp), data
+
+
+
+if __name__ == '__main__':
+    # Rough encode/decode benchmark on payloads shaped like existing topics.
+    import time
+
+    rng = np.random.default_rng(0)
+    payloads = {
+        'plume-cam': {
+            'timestamp': time.time(),
+            'center': {'x': (512.3, 0.4), 'y': (384.1, 0.3)},
+            'intensity': 1234.5,
+            'saturation': 12.0,
+            'png': rng.integers(0, 256, 600_000, dtype=np.uint8).tobytes(),
+        },
+        'spectrometer': {
+            'wavelengths': list(rng.uniform(350, 1000, 2136)),
+            'intensities': {
+                'nom': list(rng.normal(size=2136)),
+                'std': list(rng.normal(size=2136)),
+            },
+            'rough': {'surf': (1.2, 0.1)},
+        },
+        'spectrometer-arrays': {
+            'wavelengths': rng.uniform(350, 1000, 2136),
+            'intensities': {
+                'nom': rng.normal(size=2136),
+                'std': rng.normal(size=2136),
+            },
+            'rough': {'surf': (1.2, 0.1)},
+        },
+        'ctc': {
+            'temperatures': {f'ch{i}': 4.0 + i for i in range(7)},
+            'heaters': {f'heat{i}': (0.1 * i, 0.01) for i in range(4)},
+        },
+    }
+
+    for topic, payload in payloads.items():
+        for name, codec in CODECS.items():
+            n = 20
+            start = time.perf_counter()
+            for _ in range(n): frames = pack_message(topic, time.time(), payload, codec)
+            encode_time = (time.perf_counter() - start) / n
+
+            frames = [bytes(frame) for frame in frames]
+            start = time.perf_counter()
+            for _ in range(n): unpack_message(frames)
+            decode_time = (time.perf_counter() - start) / n
+
+            size = sum(len(frame) for frame in frames)
+            print(f'{topic:15s} {name:8s} encode {1e3*encode_time:8.3f} ms | decode {1e3*decode_time:8.3f} ms | {size/1024:8.1f} KB')
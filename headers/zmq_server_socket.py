@@ -9,10 +9,28 @@ import time
 
 import hashlib
 
-def create_server(topic):
+try:
+    from headers.zmq_codec import get_codec, codec_for_topic, pack_message
+except:
+    from zmq_codec import get_codec, codec_for_topic, pack_message
+
+##### Transport #####
+# By default, servers publish over TCP only. After use_inproc(), servers also bind
+# inproc://<topic> on the shared zmq context, so that clients in the same process
+# (connect_to(topic, inproc=True)) skip the network stack. Set tcp=False to stop
+# exposing the TCP port to other processes.
+_inproc = False
+_tcp = True
+
+def use_inproc(enabled=True, tcp=True):
+    global _inproc, _tcp
+    _inproc, _tcp = enabled, tcp
+
+
+def create_server(topic, codec=None, inproc=None, tcp=None):
     # Auto-assign port.
     port = int.from_bytes(hashlib.md5(topic.encode()).digest(), 'big') % 40000 + 10000
-    return zmq_server_socket(port, topic)
+    return zmq_server_socket(port, topic, codec=codec, inproc=inproc, tcp=tcp)
 
 class zmq_server_socket:
     """ 
@@ -26,7 +44,7 @@ class zmq_server_socket:
     values.
     """
 
-    def __init__(self, port, topic):
+    def __init__(self, port, topic, codec=None, inproc=None, tcp=None):
         """ This is an abstract ZMQ_socket class that creates a 
         publishing zmq socket for client zmq sockets to connect to.
         
@@ -38,15 +56,28 @@ class zmq_server_socket:
         between the sockets. It will be used to manage any sockets 
         that are connected.
         
+        The wire format is chosen by `codec` (a name from
+        headers.zmq_codec.CODECS). If not given, the default
+        for this topic is used.
+        
+        `inproc` and `tcp` choose which transports to bind. If not
+        given, the process-wide settings from use_inproc() are used.
+        
         @type self: zmq_server_socket
         @type port: int
         @type topic: string
+        @type codec: string
+        @type inproc: bool
+        @type tcp: bool
         @rtype: None
         """
-        self.zmq_context = zmq.Context() #intializes zmq       
+        self.inproc = _inproc if inproc is None else inproc
+        self.tcp = _tcp if tcp is None else tcp
+        self.zmq_context = zmq.Context.instance() if self.inproc else zmq.Context() #intializes zmq       
         self.topic = topic
         self.port = port
-        self.current_data = ""
+        self.codec = get_codec(codec or codec_for_topic(topic))
+        self.current_data = None
         self.host()
         
     def send(self, data_dict):
@@ -56,16 +87,19 @@ class zmq_server_socket:
         information. The zmq object will grab information from that 
         publisher.
         
+        Numpy arrays can be sent directly. With a binary codec they are
+        sent zero-copy, so don't modify them in-place after sending.
+        
         @type self: zmq_server_socket
         @type data_dict: Dictionary
         @rtype: None
         """
         timestamp = time.time()
-        send_string = "%s %f %s" % (self.topic, timestamp, repr(data_dict))
-        self.current_data = send_string
+        frames = pack_message(self.topic, timestamp, data_dict, self.codec)
+        self.current_data = data_dict
         # Uploads the data to the publishing socket. This lets any 
         # connecting client socket grab the available data from the pub.
-        self.pub_socket.send(send_string.encode()) 
+        self.pub_socket.send_multipart(frames, copy=False)
         
     def host(self):
         """ Creates a new zmq server publishing socket which will be
@@ -75,8 +109,11 @@ class zmq_server_socket:
         @rtype: None
         """
         self.pub_socket = self.zmq_context.socket(zmq.PUB)  #initialized to be a publishing socket
-        self.pub_socket.bind("tcp://*:%s" % self.port) #binds this zmq to the open port.
-        print('Broadcasting on port {0} with topic {1}.\n'.format(self.port, self.topic))
+        self.pub_socket.setsockopt(zmq.LINGER, 0)
+        if self.tcp: self.pub_socket.bind("tcp://*:%s" % self.port) #binds this zmq to the open port.
+        if self.inproc: self.pub_socket.bind("inproc://%s" % self.topic)
+        transport = ' + '.join((['port %s' % self.port] if self.tcp else []) + (['inproc'] if self.inproc else []))
+        print('Broadcasting on {0} with topic {1} ({2} format).\n'.format(transport, self.topic, self.codec.name))
         
     def close(self):
         """This method is used to close and destroy the publishing
@@ -86,6 +123,8 @@ class zmq_server_socket:
         @type self: zmq_server_socket
         @rtype: None
         """
+        # Free the inproc name right away, so a restarted thread can bind it again
+        if self.inproc: self.pub_socket.unbind("inproc://%s" % self.topic)
         self.pub_socket.close()
         
     def print_current_data(self):
@@ -102,7 +141,7 @@ class zmq_server_socket:
         uploaded on the publishing socket.
         
         @type self: zmq_server_client
-        @rtype: String
+        @rtype: Dictionary
         """
         return self.current_data
 
@@ -11,6 +11,7 @@ from uncertainties import ufloat
 from simple_pyspin import Camera
 
 from headers.zmq_client_socket import connect_to
+from headers.frame_ring import FrameReader
 from headers.util import plot, uarray
 
 from models.image_track import fit_image_spot
@@ -83,16 +84,32 @@ def from_png(buff, color=False):
     return cv2.imdecode(png, int(color))
 
 
+# Camera frames are read from shared memory when the camera runs on this machine.
+# Otherwise, fall back to PNGs (only sent if SEND_PNG is set in headers/frame_ring.py).
+frame_readers = {}
+def get_frame(ring, seq, png=None, color=False):
+    if seq is not None:
+        if ring not in frame_readers: frame_readers[ring] = FrameReader(ring)
+        result = frame_readers[ring].read(seq)
+        if result is not None: return result[2]
+
+    if png is not None: return from_png(png, color)
+    return None
+
+
 print('Starting.')
 start = time.monotonic()
 for i in itertools.count():
     timestamp = f'[{time.monotonic() - start:.3f}]'
 
     if 'fringe' in SHOW_CAMERAS:
-        _, data = fringe_socket.grab_json_data()
+        _, data = fringe_socket.latest()
+        frame = pattern = None
         if data is not None:
-            frame = from_png(data['png']['raw'])
-            pattern = from_png(data['png']['fringe-annotated'], color=True)
+            seqs, pngs = data.get('frames', {}), data.get('png', {})
+            frame = get_frame('fringe-cam-raw', seqs.get('raw'), pngs.get('raw'))
+            pattern = get_frame('fringe-cam-fringe-annotated', seqs.get('fringe-annotated'), pngs.get('fringe-annotated'), color=True)
+        if frame is not None and pattern is not None:
             frame = cv2.resize(frame, (720, 540))
 
             cv2.imshow('Fringe Camera', frame)
@@ -101,7 +118,7 @@ for i in itertools.count():
             print(timestamp, 'fringe')
 
     if 'cbs' in SHOW_CAMERAS:
-        _, data = cbs_socket.grab_json_data()
+        _, data = cbs_socket.latest()
         if data is not None:
             image = from_png(data['image'], color=cv2.IMREAD_ANYDEPTH).astype(int)
             image = np.maximum(np.minimum((image - 500)//3, 255), 0).astype(np.uint8)
@@ -139,9 +156,9 @@ for i in itertools.count():
         fig.canvas.flush_events()
 
     if 'webcam' in SHOW_CAMERAS:
-        _, data = webcam_socket.grab_json_data()
-        if data is not None:
-            frame = from_png(data['raw'], color=True)
+        _, data = webcam_socket.latest()
+        frame = None if data is None else get_frame('webcam', data.get('frame'), data.get('raw'), color=True)
+        if frame is not None:
             if i % 10 == 0:
                 cv2.imshow('Webcam', frame)
 
@@ -149,12 +166,11 @@ for i in itertools.count():
 
 
     if 'plume' in SHOW_CAMERAS:
-        _, data = plume_socket.grab_json_data()
-        if data is not None:
+        _, data = plume_socket.latest()
+        frame = None if data is None else get_frame('plume-cam', data.get('frame'), data.get('png'))
+        if frame is not None:
             delay = time.time() - data['timestamp']
 
-            frame = from_png(data['png'], color=False)
-
             cx = ufloat(*data['center']['x'])
             cy = ufloat(*data['center']['y'])
             intensity = data['intensity']
@@ -14,6 +14,8 @@ from colorama import Fore, Style
 
 from headers.edm_util import print_tree
 from headers.zmq_client_socket import connect_to
+from headers.log_store import LogWriter
+from headers import log_index
 
 
 ROOT_DIR = Path('~/Desktop/edm_data/logs/system_logs/').expanduser()
@@ -81,23 +83,32 @@ def update_neon_remaining(data):
 
 ## set up log file
 print('Starting logging...')
-while True:
-    _, data = monitor_socket.blocking_read()
-    timestamp = datetime.now().strftime('[%Y-%m-%d %H:%M:%S.%f]')
 
-    with open(log_file(), 'a') as f:
-        print(timestamp, json.dumps(data), file=f)
+# Columnar copy of the logs, for fast extraction (see headers/log_store.py).
+# Closing it writes out the rows that haven't been flushed yet.
+with LogWriter() as columnar_log:
+    while True:
+        _, data = monitor_socket.blocking_read()
+        now = datetime.now()
+        timestamp = now.strftime('[%Y-%m-%d %H:%M:%S.%f]')
 
-    with open(continuous_log_file, 'a') as f:
-        print(timestamp, json.dumps(data), file=f)
+        path = log_file()
+        with open(path, 'a') as f:
+            log_index.record(path, timestamp[12:17], f.tell())
+            print(timestamp, json.dumps(data), file=f)
 
+        with open(continuous_log_file, 'a') as f:
+            print(timestamp, json.dumps(data), file=f)
 
-    print()
-    print()
-    print()
-    print(f'{Style.BRIGHT}{Fore.GREEN}{timestamp}{Style.RESET_ALL}')
-    print_tree(data)
-    print()
-    update_neon_remaining(data)
+        columnar_log.append(now.timestamp(), data)
 
-    last = timestamp
+
+        print()
+        print()
+        print()
+        print(f'{Style.BRIGHT}{Fore.GREEN}{timestamp}{Style.RESET_ALL}')
+        print_tree(data)
+        print()
+        update_neon_remaining(data)
+
+        last = timestamp
@@ -6,26 +6,66 @@ and the Labjack MFC.
 
 Documentation: https://electricatoms.wordpress.com/2021/05/22/multiplexer-server-documentation/
 
+All clients of all devices are served by one asyncio event loop. Requests are
+queued per client and served round-robin, one at a time per device, on a worker
+thread for that device. Framed `query <command>` requests (see headers/usbtmc.py)
+write the command and read the response as one atomic step, so clients don't
+need the legacy lock/read/unlock protocol (which is still supported).
+Framed `binary <command>` requests are answered with a length-prefixed block
+of raw bytes instead of one escaped line, for bulk data like spectra.
+
 Author: Samuel Li
 Date: May 11, 2021
 """
 
-import socket, threading, time, serial
+import socket, threading, time, serial, asyncio, re
 import telnetlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from colorama import Fore, Style
 
+import numpy as np
+
 import seabreeze.spectrometers as sb
 
 from headers.labjack_device import Labjack
+from headers.usbtmc import escape_line, unescape_line
 
 from uncertainties import ufloat
 
 
-class Multiplexer(threading.Thread):
+# For framed `query` requests: how long to wait for a device response, and how often to poll for it.
+QUERY_TIMEOUT = 5 # seconds
+POLL_INTERVAL = 2e-3 # seconds
+# Polled responses may arrive in pieces. Keep reading until a line terminator, or no new data for this long.
+QUIET_TIME = 20e-3 # seconds
+# Longest request line accepted from a client (asyncio's default is only 64 KiB)
+MAX_LINE_LENGTH = 1 << 24 # bytes
+
+# Read-only queries that may be answered from cache: {pattern matching the whole command: time to live [s]}.
+LABJACK_CACHE_TTL = {rb'AIN\d+': 0.1, rb'READ_GENERIC \S+ \d+': 0.1, rb'READ_MANY( \S+)+': 0.1}
+CTC_CACHE_TTL = {rb'getOutput': 0.2}
+
+
+##### Event Loop #####
+# All multiplexers share one asyncio event loop, running on its own thread.
+# Blocking device I/O happens on one worker thread per device.
+_loop = None
+
+def event_loop():
+    """Return the shared event loop, starting it if needed."""
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        threading.Thread(target=_loop.run_forever, name='multiplexer').start()
+    return _loop
+
+
+class Multiplexer:
     """Allows multiple connections to be made to the same port."""
 
-    def __init__(self, local_port: int, connection, client_handler, shared_lock=None):
+    def __init__(self, local_port: int, connection, client_handler, shared_lock=None, cache_ttl=None):
         """
         Initializes a new multiplexing server.
 
@@ -36,19 +76,37 @@ class Multiplexer(threading.Thread):
             A direct connection to the device.
 
         client_handler
-            A function with signature (multiplexer, client_socket, message)
-            that handles messages from clients.
+            A function with signature (client, message) that handles messages
+            from clients. Responses are sent with client.client_socket.send(),
+            and the device is available as client.multiplexer.conn.
+
+        shared_lock
+            Optional threading.Lock, for devices that share a connection.
+
+        cache_ttl
+            Optional {regex: seconds} of read-only queries. The regex must match
+            the whole command, so b'getOutput' doesn't match b'getOutput.names'.
+            Identical queries in flight are answered together, and results are
+            reused for the given time. Any other request to the device clears the cache.
         """
-        super().__init__()
-
         # Set instance variables
         self.conn = connection
-
-        if shared_lock is None:
-            self.lock = threading.Lock()
-        else:
-            self.lock = shared_lock
+        self.lock = shared_lock
         self._handler = client_handler
+        self._port = local_port
+
+        # Requests are queued per client, and served round-robin.
+        self._queues = {} # client -> deque of (request, future)
+        self._clients = deque()
+        self._holder = None # Client with exclusive access (legacy lock/unlock protocol)
+        self._wakeup = None
+
+        self._cache_ttl = [(re.compile(pattern), ttl) for pattern, ttl in (cache_ttl or {}).items()]
+        self._cache = {} # command -> (time, reply)
+        self._in_flight = {} # command -> future, for cacheable queries
+
+        # Blocking device I/O runs here, one request at a time.
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix=f'device-{local_port}')
 
         # Create a listener server on the given port
         self._local_sock = socket.socket()
@@ -58,74 +116,218 @@ class Multiplexer(threading.Thread):
 
         print(f'Initialized new multiplexer on port {local_port}')
 
-    def run(self):
-        while True:
-            # Accept new connections forever.
-            conn, addr = self._local_sock.accept()
-            ClientThread(conn, addr, self).start()
-
-
-class ClientThread(threading.Thread):
-    def __init__(self, client_socket, addr, multiplexer):
-        super().__init__()
-        self.client_socket = client_socket
+    def start(self):
+        """Start serving clients on the shared event loop."""
+        asyncio.run_coroutine_threadsafe(self._serve(), event_loop()).result()
 
-        host, port = client_socket.getsockname()
-        self.name = f'{host}:{port}'
+    async def _serve(self):
+        self._wakeup = asyncio.Event()
+        asyncio.get_running_loop().create_task(self._schedule())
+        await asyncio.start_server(self._handle_client, sock=self._local_sock, limit=MAX_LINE_LENGTH)
 
-        self.multiplexer = multiplexer
 
-        self.client_name = f'{addr[0]}:{addr[1]}'
-        print('New client:', self.client_name)
+    ##### Clients #####
+    async def _handle_client(self, reader, writer):
+        host, port = writer.get_extra_info('peername')[:2]
+        client = f'{host}:{port}'
+        print('New client:', client)
 
-    def run(self):
-        buff = b''
+        self._queues[client] = deque()
+        self._clients.append(client)
         try:
             while True:
-                # Read packet from client.
-                msg = self.client_socket.recv(1024)
+                # Read the next line from the client.
+                # An empty read means the connection was dropped.
+                line = await reader.readline()
+                if not line: break
 
-                # Extract the next line, and keep remaining lines in a buffer.
-                # If we receive an empty packet, then crash gracefully.
-                # (Sometimes a dropped connection looks like an empty packet.)
-                (msg, *buffs) = (buff + msg).split(b'\n')
-                buff = b'\n'.join(buffs)
-                if msg == b'': break
+                msg = line.rstrip(b'\n')
+                if msg == b'': continue
 
                 # Log command (for debug)
-#                print(f'[{Fore.GREEN}RECV{Style.RESET_ALL}] {Style.DIM}{self.name:15s} < {self.client_name:15s}{Style.RESET_ALL} | {Fore.GREEN}{msg}{Style.RESET_ALL}')
-
-                # Acquire thread lock for safe atomic read
-                if msg == b'lock':
-                    self.multiplexer.lock.acquire()
-                    self.client_socket.send(b'locked')
-#                    print(f'[{Fore.RED}SEND{Style.RESET_ALL}] {Style.DIM}{self.name:15s} > {self.client_name:15s}{Style.RESET_ALL} | {Fore.BLUE}locked{Style.RESET_ALL}')
-                    continue
-
-                # Discard thread lock. Sometimes yells about unlocking
-                # if already unlocked, but nobody cares.
-                if msg == b'unlock':
-                    try:
-                        self.multiplexer.lock.release()
-                    finally:
-                        self.client_socket.send(b'unlocked')
-#                        print(f'[{Fore.RED}SEND{Style.RESET_ALL}] {Style.DIM}{self.name:15s} > {self.client_name:15s}{Style.RESET_ALL} | {Fore.BLUE}unlocked{Style.RESET_ALL}')
-                        continue
-
-                # Pass on the request to the handler function,
-                # where stuff actually happens.
+#                print(f'[{Fore.GREEN}RECV{Style.RESET_ALL}] {Style.DIM}{self._port} < {client:15s}{Style.RESET_ALL} | {Fore.GREEN}{msg}{Style.RESET_ALL}')
+
+                # Framed requests: write (and read) atomically, reply with one line.
+                if msg.startswith(b'query ') or msg.startswith(b'send ') or msg.startswith(b'binary '):
+                    kind, command = msg.split(b' ', 1)
+                    request = (kind.decode('utf-8'), unescape_line(command))
+
+                # Legacy protocol: lock, raw commands, read, unlock.
+                elif msg in [b'lock', b'unlock']:
+                    request = (msg.decode('utf-8'), None)
+                else:
+                    request = ('raw', msg)
+
+                reply = await self._request(client, request)
+                if reply:
+                    writer.write(reply)
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            print(e)
+        except ValueError as e:
+            # readline() raises this for lines longer than MAX_LINE_LENGTH
+            print(f'{Fore.RED}Request from {client} too long:{Style.RESET_ALL}', e)
+        finally:
+            # Clean up this connection.
+            self._drop(client)
+            writer.close()
+            print(f'[{Fore.BLUE}INFO{Style.RESET_ALL}] {self._port} | client {client} dropped')
+
+    async def _request(self, client, request):
+        """Submit a request, answering cacheable queries from cache or an identical one in flight."""
+        kind, command = request
+        ttl = self._ttl(kind, command)
+        if ttl is None: return await self._submit(client, request)
+
+        cached = self._cache.get(command)
+        if cached is not None and time.monotonic() - cached[0] < ttl: return cached[1]
+
+        shared = self._in_flight.get(command)
+        if shared is not None:
+            try:
+                return await asyncio.shield(shared)
+            except asyncio.CancelledError:
+                if not shared.cancelled(): raise
+                # The client that submitted it dropped. Submit our own.
+
+        future = self._submit(client, request)
+        self._in_flight[command] = future
+        try:
+            return await future
+        finally:
+            if self._in_flight.get(command) is future: del self._in_flight[command]
+
+    def _ttl(self, kind, command):
+        if kind != 'query': return None
+        for pattern, ttl in self._cache_ttl:
+            if pattern.fullmatch(command): return ttl
+        return None
+
+    def _submit(self, client, request):
+        future = asyncio.get_running_loop().create_future()
+        self._queues[client].append((request, future))
+        self._wakeup.set()
+        return future
+
+    def _drop(self, client):
+        for request, future in self._queues.pop(client, []): future.cancel()
+        if client in self._clients: self._clients.remove(client)
+        if self._holder == client: self._holder = None
+        self._wakeup.set()
+
+
+    ##### Scheduling #####
+    def _next_client(self):
+        """Return the next client with a pending request, in round-robin order."""
+        if self._holder is not None:
+            return self._holder if self._queues.get(self._holder) else None
+
+        for _ in range(len(self._clients)):
+            client = self._clients[0]
+            self._clients.rotate(-1)
+            if self._queues[client]: return client
+        return None
+
+    async def _schedule(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            client = self._next_client()
+            if client is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            (kind, command), future = self._queues[client].popleft()
+            if kind == 'lock':
+                self._holder = client
+                result = b'locked'
+            elif kind == 'unlock':
+                self._holder = None
+                result = b'unlocked'
+            else:
                 try:
-                    self.multiplexer._handler(self, msg)
+                    result = await loop.run_in_executor(self._executor, self._execute, client, kind, command)
                 except Exception as e:
                     print('Error in handler:', e)
+                    result = b''
+
+                # Cache read-only results. Anything else may change the device state.
+                if self._ttl(kind, command) is not None:
+                    if result.startswith(b'+'): self._cache[command] = (time.monotonic(), result)
+                elif (kind, command) != ('raw', b'read'):
+                    self._cache.clear()
+
+            if not future.done(): future.set_result(result)
+
+
+    ##### Device I/O (runs on the device thread) #####
+    def _execute(self, client, kind, command):
+        if self.lock is None: return self._run_request(client, kind, command)
+        with self.lock: return self._run_request(client, kind, command)
+
+    def _run_request(self, client, kind, command):
+        capture = CapturedClient(self, client)
+
+        # Legacy requests: pass on to the handler, reply with whatever it sends.
+        if kind == 'raw':
+            self._handler(capture, command)
+            return capture.response()
+
+        try:
+            self._handler(capture, command)
+
+            # Devices that don't answer immediately are polled with 'read' until they do.
+            deadline = time.monotonic() + QUERY_TIMEOUT
+            polled = False
+            while kind != 'send' and not capture.sent:
+                if time.monotonic() > deadline: raise TimeoutError('No response from device')
+                time.sleep(POLL_INTERVAL)
+                self._handler(capture, b'read')
+                if capture.response() == b'read failed': capture.clear()
+                polled = True
+
+            # Then read the rest of the response, until it ends with a terminator or goes quiet.
+            last_data = time.monotonic()
+            while polled and not capture.response().endswith(b'\n'):
+                now = time.monotonic()
+                if now - last_data > QUIET_TIME or now > deadline: break
+                time.sleep(POLL_INTERVAL)
+
+                length = len(capture.response())
+                self._handler(capture, b'read')
+                capture.discard(b'read failed')
+                if len(capture.response()) > length: last_data = time.monotonic()
+
+            response = capture.response() if kind != 'send' else b''
+            if kind == 'binary': return b'#%d\n' % len(response) + response
+            return b'+' + escape_line(response) + b'\n'
         except Exception as e:
-            print(e)
-        finally:
-            # Clean up this connection.
-            self.client_socket.close()
-            if self.multiplexer.lock.locked():
-                self.multiplexer.lock.release()
-            print(f'[{Fore.BLUE}INFO{Style.RESET_ALL}] {self.name} | client {self.client_name} dropped')
+            return b'-' + escape_line(repr(e).encode('utf-8')) + b'\n'
+
+
+class CapturedClient:
+    """Passed to handlers in place of a client connection, so that responses can be collected."""
+    def __init__(self, multiplexer, client_name):
+        self.multiplexer = multiplexer
+        self.name = str(multiplexer._port)
+        self.client_name = client_name
+        self.client_socket = self
+        self.clear()
+
+    def send(self, data):
+        self.sent = True
+        self._data.append(data)
+        return len(data)
+
+    def response(self): return b''.join(self._data)
+
+    def discard(self, data):
+        """Remove the last thing sent, if it is `data`."""
+        if self._data and self._data[-1] == data: self._data.pop()
+
+    def clear(self):
+        self.sent = False
+        self._data = []
 
 
 ##### Connection Handlers #####
@@ -196,6 +398,13 @@ def labjack_handler(client_thread, msg):
         res = conn.read(channel.decode('utf-8'), n_samples=int(samples))
         client_socket.send(f'{res.n:.8g} {res.s:.8g}'.encode('utf-8'))
 
+    # Client wants to read several channels at once, as one snapshot.
+    # Replies with the value and uncertainty of each channel, in order.
+    if msg.startswith(b'READ_MANY'):
+        channels = msg.decode('utf-8').split()[1:]
+        res = conn.read_many(channels)
+        client_socket.send(' '.join(f'{x.n:.8f} {x.s:.8f}' for x in res).encode('utf-8'))
+
 
 def spectrometer_handler(client_thread, msg):
     conn = client_thread.multiplexer.conn
@@ -213,15 +422,21 @@ def spectrometer_handler(client_thread, msg):
         except Exception as e:
             client_socket.send(repr(e).encode('utf-8'))
 
+    # 'WAVELENGTHS BINARY' and 'INTENSITIES BINARY' send little-endian float32 arrays,
+    # for use with framed `binary` requests. Otherwise, send space-separated text.
     if msg.startswith(b'WAVELENGTHS'):
-        # Send the response, formatted as bytes.
-        response = ' '.join(f'{x:.3f}' for x in conn.wavelengths())
-        client_socket.send(response.encode('utf-8'))
+        if msg.endswith(b'BINARY'):
+            client_socket.send(np.asarray(conn.wavelengths(), dtype='<f4').tobytes())
+        else:
+            response = ' '.join(f'{x:.3f}' for x in conn.wavelengths())
+            client_socket.send(response.encode('utf-8'))
 
     if msg.startswith(b'INTENSITIES'):
-        # Send the response, formatted as bytes.
-        response = ' '.join(f'{x:.6g}' for x in conn.intensities())
-        client_socket.send(response.encode('utf-8'))
+        if msg.endswith(b'BINARY'):
+            client_socket.send(np.asarray(conn.intensities(), dtype='<f4').tobytes())
+        else:
+            response = ' '.join(f'{x:.6g}' for x in conn.intensities())
+            client_socket.send(response.encode('utf-8'))
 
     if msg.startswith(b'GET_TEMP'):
         # Send the response, formatted as bytes.
@@ -243,7 +458,7 @@ if __name__ == '__main__':
     TC1 = telnetlib.Telnet('192.168.0.104', port=23, timeout=2)
     TC2 = telnetlib.Telnet('192.168.0.107', port=23, timeout=2)
 
-    mfc = Labjack(470017292)
+    mfc = Labjack(470017292, stream_channels=['AIN0', 'AIN1', 'AIN2'])
     upper_labjack = Labjack(470022275)
     turbo = serial.Serial('/dev/turbo', 9600, timeout=0.2)
     verdi = serial.Serial('/dev/verdi', 19200, timeout=0.15)
@@ -258,11 +473,11 @@ if __name__ == '__main__':
 
 
     # Start multiplexer servers
-    Multiplexer(31415, TC1, telnet_handler).start()
-    Multiplexer(31416, TC2, telnet_handler).start()
+    Multiplexer(31415, TC1, telnet_handler, cache_ttl=CTC_CACHE_TTL).start()
+    Multiplexer(31416, TC2, telnet_handler, cache_ttl=CTC_CACHE_TTL).start()
 
-    Multiplexer(31417, mfc, labjack_handler).start()
-    Multiplexer(31419, upper_labjack, labjack_handler).start()
+    Multiplexer(31417, mfc, labjack_handler, cache_ttl=LABJACK_CACHE_TTL).start()
+    Multiplexer(31419, upper_labjack, labjack_handler, cache_ttl=LABJACK_CACHE_TTL).start()
 
     Multiplexer(31418, turbo, serial_handler).start()
     Multiplexer(31420, verdi, verdi_handler).start()
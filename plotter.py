@@ -14,6 +14,7 @@ import matplotlib
 if HEADLESS: matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mpdates
+from matplotlib.collections import PolyCollection
 from matplotlib import rcParams
 rcParams['timezone'] = 'Canada/Eastern'
 rcParams['font.family'] = 'sans-serif'
@@ -24,6 +25,9 @@ import tkinter as tk
 
 from uncertainties import ufloat
 
+from headers.field_extractor import compile_fields
+from headers.ring_buffer import DecimatedBuffer
+
 
 MINUTE = 60
 HOUR = 60 * MINUTE
@@ -36,8 +40,9 @@ if HEADLESS:
     duration = float(sys.argv[1]) * HOUR
 
 
-# skip every x points.
-skip_points = max(1, round(duration / (2 * HOUR)))
+# max points per trace. Longer windows are drawn from block averages (see headers/ring_buffer.py).
+MAX_PLOT_POINTS = 2000
+DECIMATION_FACTOR = 4
 
 
 # how fast the publisher is
@@ -47,6 +52,13 @@ publisher_rate = 1.4/2 # Hertz
 # how often to update plot.
 PLOT_INTERVAL = 30 if HEADLESS else 2
 
+# Redraw only the traces (not axes, ticks, legends) in the interactive window.
+BLIT = not HEADLESS
+
+# Empty space kept to the right of the newest point, as a fraction of the window.
+# The x axis (and with it the blitting background) only has to move when the data reaches the edge.
+X_HEADROOM = 0.05
+
 
 
 # Map from plot labels (name, unit) to paths in data
@@ -208,8 +220,9 @@ filepath = '/home/vuthalab/Desktop/edm_data/logs/system_logs/continuous.txt'
 
 
 ###### initial plot #####
-num_points = round(publisher_rate * duration / skip_points)
-print(f'Showing last {num_points * skip_points} points (skip every {skip_points}).')
+num_samples = round(publisher_rate * duration)
+buffer = DecimatedBuffer.for_window(MAX_PLOT_POINTS, num_samples, shape=(len(fields), 2), factor=DECIMATION_FACTOR)
+print(f'Showing last {num_samples} points ({buffer.levels} decimation levels).')
 
 if not HEADLESS: plt.ion()
 
@@ -223,7 +236,7 @@ axes = gs.subplots(sharex=True, sharey=False)
 
 # Initialize empty plots
 graphs = []
-bands = [None] * len(fields)
+bands = []
 colors = defaultdict(int)
 for j, field in enumerate(fields):
     name, unit = field
@@ -231,7 +244,7 @@ for j, field in enumerate(fields):
     i = axis_labels.index(unit)
     color = colors[i]
     graph = axes[i].plot_date(
-        num_points * [None], num_points * [None],
+        [], [],
         linestyle='solid', linewidth=1,
         marker=None, label=name,
         color=f'C{color}'
@@ -239,6 +252,14 @@ for j, field in enumerate(fields):
     colors[i] += 1
     graphs.append((i, color, graph))
 
+    # Uncertainty band. Its polygons are updated in place on every redraw.
+    band = PolyCollection([], alpha=0.3, color=f'C{color}', zorder=-10)
+    axes[i].add_collection(band, autolim=False)
+    bands.append(band)
+
+axis_fields = defaultdict(list) # axis index -> field indices
+for j, (i, color, graph) in enumerate(graphs): axis_fields[i].append(j)
+
 # Subplot tweaks
 for axis, label in zip(axes, axis_labels):
     axis.legend(loc='upper left')
@@ -255,110 +276,148 @@ plt.gca().xaxis.set_major_formatter(formatter)
 for label in ['torr', 'uW into wavemeter']:#, 'μs', '']:
     axes[axis_labels.index(label)].set_yscale('log')
 
-##### animated plot #####
-times = np.array([datetime.datetime.now()] * num_points)
-data = np.zeros((num_points, len(fields), 2))
+##### incremental drawing #####
+def band_polygons(x, lower, upper):
+    """Polygons for a band between lower and upper, split at NaNs like fill_between."""
+    valid = np.isfinite(lower) & np.isfinite(upper)
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], valid.astype(int), [0]])))
 
-last = 0
-for i, line in enumerate(tail('-n', num_points * skip_points, '-f', filepath, _iter=True)):
-    if i % skip_points == 0:
-        try:
-            timestamp, raw_data = line.split(']', 1)
-            timestamp = datetime.datetime.strptime(timestamp[1:], '%Y-%m-%d %H:%M:%S.%f')
-            timestamp += datetime.timedelta(hours=4) # fix timezone (correct in logs, wrong on plot?)
-
-            raw_data = json.loads(raw_data)
-        except:
-            continue
-
-        # Filter out relevant fields
-        processed_data = []
-        for path in fields.values():
-            try:
-                value = raw_data
-                for entry in path:
-                    value = value[entry]
-            except:
-                value = None
-
-            if isinstance(value, str): value = None
-
-            if not isinstance(value, list):
-                value = (value, 0)
-
-            processed_data.append(value)
-        processed_data = np.array(processed_data)
-
-        # Add datapoint
-        times[:-1] = times[1:]
-        times[-1] = timestamp
-
-        data[:-1] = data[1:]
-        data[-1] = processed_data
+    polygons = []
+    for start, stop in zip(edges[::2], edges[1::2]):
+        xs = x[start:stop]
+        polygons.append(np.column_stack([
+            np.concatenate([xs, xs[::-1]]),
+            np.concatenate([lower[start:stop], upper[start:stop][::-1]]),
+        ]))
+    return polygons
 
-    if (
-        time.monotonic() - last < PLOT_INTERVAL # Avoid plot bottlenecking data read
-        and
-        abs(i/skip_points - num_points) > 2 # Update a few times manually to get the initial plot
-    ): continue
 
-    fig.canvas.flush_events()
-    time.sleep(0.05)
+def needs_rescale(axis, values):
+    """Whether the data no longer fits the y limits, or fills less than half of them."""
+    if axis.get_yscale() == 'log':
+        values = np.log10(values[values > 0])
+        limits = np.log10(np.clip(axis.get_ylim(), 1e-300, None))
+    else:
+        values = values[np.isfinite(values)]
+        limits = axis.get_ylim()
+
+    if len(values) == 0: return False
+    low, high = values.min(), values.max()
+    if low < limits[0] or high > limits[1]: return True
+
+    # Only shrink the limits for data that actually varies.
+    # Flat traces (heaters off, zero flow) would otherwise rescale every frame.
+    if high - low <= 1e-9 * max(abs(low), abs(high)): return False
+    return (high - low) < 0.5 * (limits[1] - limits[0])
 
-    if i % skip_points == 0:
-        # Plot data
-        start_time = time.monotonic()
-        for j, entry in enumerate(graphs):
-            k, color, graph = entry
-            trace, uncertainty = data[:, j].T
-            graph.set_xdata(times)
-            graph.set_ydata(trace)
 
-            if bands[j] is not None:
-                bands[j].remove()
-            bands[j] = axes[k].fill_between(
-                times,
-                trace - 2*uncertainty,
-                trace + 2*uncertainty,
-                alpha=0.3,
-                color=f'C{color}',
-                zorder=-10
-            )
+animated = [graph for _, _, graph in graphs] + bands
+background = None
 
-        for axis in axes:
-            axis.relim()
-            axis.autoscale_view()
+def draw_animated():
+    for artist in animated: artist.axes.draw_artist(artist)
 
-        thread_status = ''
-        if 'thread-up' in raw_data:
-            threads_down = [name for name, up in raw_data['thread-up'].items() if not up]
-            if threads_down:
-                thread_status = '\n\n' + ', '.join(threads_down) + ' thread down!'
+def on_draw(event):
+    """Grab the static background after every full draw (including resizes)."""
+    global background
+    background = fig.canvas.copy_from_bbox(fig.bbox)
+    draw_animated()
 
-        if 'running' in raw_data:
-            running = raw_data['running']
-            def get_status(name):
-                return 'Running' if running.get(name, False) else 'Off'
+if BLIT:
+    for artist in animated: artist.set_animated(True)
+    fig.canvas.mpl_connect('draw_event', on_draw)
 
-            pt_status = get_status('pt')
-            turbo_status = get_status('turbo')
-            verdi_status = get_status('verdi')
 
 
-            title = f'Pulse Tube {pt_status} · Turbo {turbo_status} · Verdi {verdi_status} · {time.asctime(time.localtime())}{thread_status}'
+##### animated plot #####
+extract_fields = compile_fields(list(fields.values()))
 
-            if HEADLESS:
-                axes[0].set_title(title, pad=20)
-            else:
-                fig.canvas.set_window_title(title)
+row = np.full((len(fields), 2), np.nan)
 
-        fig.canvas.draw()
+last = 0
+for i, line in enumerate(tail('-n', num_samples, '-f', filepath, _iter=True)):
+    try:
+        timestamp, raw_data = line.split(']', 1)
+        timestamp = datetime.datetime.strptime(timestamp[1:], '%Y-%m-%d %H:%M:%S.%f')
+        timestamp += datetime.timedelta(hours=4) # fix timezone (correct in logs, wrong on plot?)
 
+        raw_data = json.loads(raw_data)
+    except:
+        continue
 
-        last = time.monotonic()
+    # Add datapoint
+    extract_fields(raw_data, row[:, 0], row[:, 1]) # Missing fields become (nan, 0)
+    buffer.append(mpdates.date2num(timestamp), row)
 
-        print(f'Plot took {last - start_time:.3f} s')
+    if (
+        time.monotonic() - last < PLOT_INTERVAL # Avoid plot bottlenecking data read
+        and
+        abs(i - num_samples) > 2 # Update a few times manually to get the initial plot
+    ): continue
+
+    fig.canvas.flush_events()
+    time.sleep(0.05)
+
+    # Plot data from the finest level covering the whole window
+    start_time = time.monotonic()
+    times, data = buffer.window(duration / (24 * HOUR)) # matplotlib dates are in days
+    for j, entry in enumerate(graphs):
+        k, color, graph = entry
+        trace, uncertainty = data[:, j].T
+        graph.set_data(times, trace)
+        bands[j].set_verts(band_polygons(times, trace - 2*uncertainty, trace + 2*uncertainty))
+
+    # Only move the x axis when the newest point reaches the right edge
+    full_redraw = background is None or not BLIT
+    x_min, x_max = axes[0].get_xlim()
+    span = duration / (24 * HOUR)
+    if len(times) and (times[-1] > x_max or not np.isclose(x_max - x_min, (1 + X_HEADROOM) * span)):
+        axes[0].set_xlim(times[-1] - span, times[-1] + X_HEADROOM * span)
+        full_redraw = True
+
+    # Only rescale axes whose data range changed
+    for k, axis in enumerate(axes):
+        if not needs_rescale(axis, data[:, axis_fields[k], 0].ravel()): continue
+        axis.relim()
+        axis.autoscale_view(scalex=False)
+        full_redraw = True
+
+    thread_status = ''
+    if 'thread-up' in raw_data:
+        threads_down = [name for name, up in raw_data['thread-up'].items() if not up]
+        if threads_down:
+            thread_status = '\n\n' + ', '.join(threads_down) + ' thread down!'
+
+    if 'running' in raw_data:
+        running = raw_data['running']
+        def get_status(name):
+            return 'Running' if running.get(name, False) else 'Off'
+
+        pt_status = get_status('pt')
+        turbo_status = get_status('turbo')
+        verdi_status = get_status('verdi')
+
+
+        title = f'Pulse Tube {pt_status} · Turbo {turbo_status} · Verdi {verdi_status} · {time.asctime(time.localtime())}{thread_status}'
 
         if HEADLESS:
-            plt.savefig(f'/tmp/log-{round(duration)}.png', dpi=150)
-            subprocess.run(f'scp /tmp/log-{round(duration)}.png celine@143.110.210.120:~/server/', shell=True)
+            axes[0].set_title(title, pad=20)
+        else:
+            fig.canvas.set_window_title(title)
+
+    if not HEADLESS: # In headless mode, savefig below draws the figure
+        if full_redraw:
+            fig.canvas.draw() # Calls on_draw, which also grabs the new background
+        else:
+            fig.canvas.restore_region(background)
+            draw_animated()
+            fig.canvas.blit(fig.bbox)
+
+
+    last = time.monotonic()
+
+    print(f'Plot took {last - start_time:.3f} s')
+
+    if HEADLESS:
+        plt.savefig(f'/tmp/log-{round(duration)}.png', dpi=150)
+        subprocess.run(f'scp /tmp/log-{round(duration)}.png celine@143.110.210.120:~/server/', shell=True)
@@ -4,15 +4,18 @@ import threading
 import psutil
 import traceback
 import random
+import functools
 from collections import defaultdict
 
+import zmq
 from colorama import Fore, Style
 from uncertainties import ufloat
 
-from headers.zmq_server_socket import create_server
+from headers.zmq_server_socket import create_server, use_inproc
 from headers.zmq_client_socket import connect_to
 
 from headers.edm_util import deconstruct, print_tree, memory_usage
+from headers.supervisor import Supervisor
 
 from headers.rigol_ds1102e import RigolDS1102e
 
@@ -41,6 +44,40 @@ from threads.interlock import interlock_thread
 
 PUBLISH_INTERVAL = 2/1.4 # publish every x seconds.
 
+# 'interval': poll all threads once per PUBLISH_INTERVAL.
+# 'event': merge thread data as it arrives (zmq.Poller), so published data is never a full interval stale.
+#   Note that in event mode, a thread counts as up (and its last data is republished and logged)
+#   until it has sent nothing for STALE_AFTER seconds.
+PUBLISH_MODE = 'interval'
+
+# Event mode only. If true, publish as soon as any thread sends new data
+# (at most every MIN_PUBLISH_INTERVAL), instead of every PUBLISH_INTERVAL.
+# Note that this raises the logging rate.
+PUBLISH_ON_CHANGE = False
+MIN_PUBLISH_INTERVAL = 0.2 # seconds
+
+# Event mode only. Threads with no new data for this long are marked as down.
+STALE_AFTER = 10 # seconds
+
+# Threads send data to the main publisher in-process (inproc://), on one shared zmq context.
+# If EXPOSE_TCP is set, each thread is also published on its TCP port,
+# for other programs (e.g. liveplot_camera.py, api/). The edm-monitor publisher always uses TCP.
+# In-process connections don't recover when a crashed thread restarts, so threads
+# with no new data for STALE_AFTER seconds are reconnected.
+INPROC = True
+EXPOSE_TCP = True
+
+# 'thread': run all device threads in this process.
+# 'process': run each device thread in its own process, so that CPU-heavy threads
+# (cameras, spectrometer fits) don't starve the others. Processes are restarted if
+# they exit, or if they stop responding for HEARTBEAT_TIMEOUT seconds.
+# Per-process CPU and memory usage is published in data['debug']['processes'].
+# Processes always publish over TCP.
+ISOLATION = 'thread'
+HEARTBEAT_TIMEOUT = 30 # seconds
+
+USE_INPROC = INPROC and ISOLATION == 'thread'
+
 ##### Dictionary of threads. Key must be the name of the publisher each thread creates. #####
 THREADS = {
 #    'spectrometer': spectrometer_thread,
@@ -68,197 +105,315 @@ THREADS = {
 fringe_counter = FringeCounter()
 growth_model = GrowthModel()
 
+def process_data(raw_data, thread_up, updated):
+    """
+    Build the edm-monitor tree from the latest data of each thread.
+
+    raw_data: latest message of each thread, by name.
+    thread_up: whether each thread is considered alive.
+    updated: names of threads that sent new data since the last publish.
+    """
+    ##### Extract/rearrange all relevant data. Change this when adding new threads. #####
+    data = {}
+    data['thread-up'] = dict(thread_up)
+    data['running'] = {}
+    data['freq'] = {}
+
+    if thread_up['ctc']:
+        data['temperatures'] = raw_data['ctc']['temperatures']
+        data['heaters'] = raw_data['ctc']['heaters']
+    else:
+        data['temperatures'] = {}
+
+    if thread_up['spectrometer'] or raw_data['spectrometer'] is not None:
+        data['rough'] = raw_data['spectrometer']['rough']
+        data['trans'] = raw_data['spectrometer']['trans']
+        data['rough']['hdr-chisq'] = raw_data['spectrometer']['fit']['chisq']
+
+    if thread_up['wavemeter']:
+        data['freq'] = raw_data['wavemeter']['freq']
+        data['intensities'] = raw_data['wavemeter']['power']
+        data['error-signals'] = raw_data['wavemeter']['voltages']
+#        data['linewidths'] = raw_data['wavemeter']['linewidth']
+        if 'temp' in raw_data['wavemeter']: # Left out when the temperature didn't update
+            data['temperatures']['wavemeter'] = raw_data['wavemeter']['temp']
+
+    if thread_up['usb4000']:
+        data['ti-saph'] = raw_data['usb4000']
+        freq = raw_data['usb4000']['frequency']
+        if freq is not None:
+            data['freq']['ti-saph-spec'] = freq
+
+    if thread_up['qe-pro']:
+        data['temperatures']['qe-pro'] = raw_data['qe-pro']['temperature']
+
+    if thread_up['ei1050']:
+        data['temperatures']['fridge'] = raw_data['ei1050']['temperature']
+        data['fridge'] = raw_data['ei1050']
+
+    if thread_up['pressure']:
+        data['pressure'] = raw_data['pressure']['pressure']
+
+    if thread_up['mfc']:
+        data['flows'] = raw_data['mfc']
+
+    if thread_up['turbo']:
+        data['running']['turbo'] = raw_data['turbo']['running']
+        data['turbo'] = raw_data['turbo']
+
+    if thread_up['pt']:
+        data['pt'] = raw_data['pt']
+        data['running']['pt'] = raw_data['pt']['running']
+
+    if thread_up['fringe-cam']:
+        data['refl'] = raw_data['fringe-cam']['refl']
+        data['center'] = raw_data['fringe-cam']['center']
+
+    if thread_up['verdi']:
+        data['verdi'] = raw_data['verdi']['status']
+        data['running'] = {**data['running'], **raw_data['verdi']['running']}
+        data['temperatures']['verdi'] = data['verdi']['temp']
+
+    if thread_up['scope']:
+        if 'pmt' not in data: data['pmt'] = {}
+        v1 = ufloat(*raw_data['scope']['ch1'])
+        resistor = 10e3
+        data['pmt']['current'] = deconstruct(-1e6 * v1/resistor)
+
+    if thread_up['labjack']:
+#        if 'pump' not in data: data['pump'] = {}
+        if 'pmt' not in data: data['pmt'] = {}
+        data['pmt']['gain'] = raw_data['labjack']['dac0']
+
+    if thread_up['plume-cam']:
+        data['ablation'] = {
+            'center': raw_data['plume-cam']['center'],
+            'intensity': raw_data['plume-cam']['intensity'],
+            'saturation': raw_data['plume-cam']['saturation'],
+        }
+
+    if thread_up['interlock']:
+        data['interlock-uptime'] = raw_data['interlock']['uptime']
+
+
+    # Update models
+    try:
+        if thread_up['ctc'] and thread_up['mfc']:
+            saph_temp = data['temperatures']['saph']
+
+            if saph_temp is not None:
+                growth_model.update(
+                    ufloat(*data['flows']['neon']),
+                    ufloat(*data['flows']['cell']),
+                    saph_temp
+                )
+                data['height'] = deconstruct(growth_model.height)
+
+                if 'fringe-cam' in updated:
+                    fringe_counter.update(
+                        data['refl']['ai'][0],
+                        grow=(growth_model._growth_rate.n > 0)
+                    )
+                    if saph_temp > 13: fringe_counter.reset()
+                    data['fringe'] = {
+                        'count': fringe_counter.fringe_count,
+                        'ampl': fringe_counter.amplitude,
+                    }
+    except Exception as e:
+        print('Error:', e)
+
+
+#    if thread_up['scope'] and 'freq' in data:
+#        freq = None
+#
+#        if 'ti-saph' in data['freq']:
+#            freq = ufloat(*data['freq']['ti-saph'])
+#        elif 'ti-saph-spec' in data['freq']:
+#            freq = ufloat(*data['freq']['ti-saph-spec'])
+#
+#        if freq is not None:
+#            v1 = ufloat(*data['pump']['v1'])
+#            v2 = ufloat(*data['pump']['v2'])
+#
+#            speed_of_light = 299792458
+#            wl = speed_of_light / freq
+#
+#            power_vert, power_horiz, angle = power_and_polarization(v1, v2, wl)
+#            data['pump']['power'] = deconstruct(power_vert + power_horiz)
+#            data['pump']['power-vert'] = deconstruct(power_vert)
+#            data['pump']['power-horiz'] = deconstruct(power_horiz)
+#            data['pump']['angle'] = deconstruct(angle)
+#
+#            if 'eom-gain' in data['pump']:
+#                gain = ufloat(*data['pump']['eom-gain'])
+#                model_angle = eom_angle_from_gain(gain, wl)
+#                data['pump']['angle-model'] = deconstruct(model_angle)
+
+    return data
+
+
+supervisor = None # Set in process isolation mode
+
+def add_debug_info(data, publisher_start, first):
+    uptime = (time.monotonic() - publisher_start)/3600
+    data['debug'] = {
+        'uptime': uptime if not first else None,
+        'memory': memory_usage(),
+        'system-memory': round(psutil.virtual_memory().used / 1024),
+        'cpu': psutil.cpu_percent(),
+    }
+    if supervisor is not None: data['debug']['processes'] = supervisor.stats()
+
+
 def run_publisher():
     print('Initializing devices...')
 
     monitors = {
-        key: connect_to(key)
+        key: connect_to(key, inproc=USE_INPROC)
         for key in THREADS.keys()
     }
 
+    print(f'Starting publisher ({PUBLISH_MODE} mode)')
+    with create_server('edm-monitor', inproc=False, tcp=True) as publisher:
+        if PUBLISH_MODE == 'event':
+            run_event_loop(monitors, publisher)
+        else:
+            run_interval_loop(monitors, publisher)
 
-    # Special case for spectrometer: keep cache of last datapoint
-    spec_cache = None
 
+# Dicts in thread data that process_data modifies in-place: (thread, key)
+MUTATED_BY_PROCESSING = [('ctc', 'temperatures'), ('spectrometer', 'rough'), ('wavemeter', 'freq')]
+
+def copy_for_processing(raw_data):
+    """Copy only the parts of raw_data that process_data modifies, so the originals can be reused."""
+    snapshot = dict(raw_data)
+    for thread, key in MUTATED_BY_PROCESSING:
+        if snapshot.get(thread) is not None and key in snapshot[thread]:
+            snapshot[thread] = {**snapshot[thread], key: dict(snapshot[thread][key])}
+    return snapshot
 
-    print('Starting publisher')
-    publisher_start = time.monotonic()
-    with create_server('edm-monitor') as publisher:
-        for loop_iteration in itertools.count(1):
-            ##### Get data from all the threads. No need to change this part. #####
-            raw_data = {}
-            for key, monitor in monitors.items():
-                while True:
-                    _, thread_data = monitor.grab_json_data()
-                    if thread_data is None: break
-                    raw_data[key] = thread_data
-
-            thread_up = defaultdict(lambda: False, {
-                key: (key in raw_data)
-                for key in THREADS.keys()
-            })
-
-            # Artificially fill in values if spectrometer doesn't return anything
-            if 'spectrometer' in raw_data:
-                spec_cache = raw_data['spectrometer']
-            else:
-                raw_data['spectrometer'] = spec_cache
-
-
-            ##### Extract/rearrange all relevant data. Change this when adding new threads. #####
-            data = {}
-            data['thread-up'] = dict(thread_up)
-            data['running'] = {}
-            data['freq'] = {}
-
-            if thread_up['ctc']:
-                data['temperatures'] = raw_data['ctc']['temperatures']
-                data['heaters'] = raw_data['ctc']['heaters']
-            else:
-                data['temperatures'] = {}
-
-            if thread_up['spectrometer'] or spec_cache is not None:
-                data['rough'] = raw_data['spectrometer']['rough']
-                data['trans'] = raw_data['spectrometer']['trans']
-                data['rough']['hdr-chisq'] = raw_data['spectrometer']['fit']['chisq']
-
-            if thread_up['wavemeter']:
-                data['freq'] = raw_data['wavemeter']['freq']
-                data['intensities'] = raw_data['wavemeter']['power']
-                data['error-signals'] = raw_data['wavemeter']['voltages']
-#                data['linewidths'] = raw_data['wavemeter']['linewidth']
-                data['temperatures']['wavemeter'] = raw_data['wavemeter']['temp']
-
-            if thread_up['usb4000']:
-                data['ti-saph'] = raw_data['usb4000']
-                freq = raw_data['usb4000']['frequency']
-                if freq is not None:
-                    data['freq']['ti-saph-spec'] = freq
-
-            if thread_up['qe-pro']:
-                data['temperatures']['qe-pro'] = raw_data['qe-pro']['temperature']
-
-            if thread_up['ei1050']:
-                data['temperatures']['fridge'] = raw_data['ei1050']['temperature']
-                data['fridge'] = raw_data['ei1050']
-
-            if thread_up['pressure']:
-                data['pressure'] = raw_data['pressure']['pressure']
-
-            if thread_up['mfc']:
-                data['flows'] = raw_data['mfc']
-
-            if thread_up['turbo']:
-                data['running']['turbo'] = raw_data['turbo']['running']
-                data['turbo'] = raw_data['turbo']
-
-            if thread_up['pt']:
-                data['pt'] = raw_data['pt']
-                data['running']['pt'] = raw_data['pt']['running']
-
-            if thread_up['fringe-cam']:
-                data['refl'] = raw_data['fringe-cam']['refl']
-                data['center'] = raw_data['fringe-cam']['center']
-
-            if thread_up['verdi']:
-                data['verdi'] = raw_data['verdi']['status']
-                data['running'] = {**data['running'], **raw_data['verdi']['running']}
-                data['temperatures']['verdi'] = data['verdi']['temp']
-
-            if thread_up['scope']:
-                if 'pmt' not in data: data['pmt'] = {}
-                v1 = ufloat(*raw_data['scope']['ch1'])
-                resistor = 10e3
-                data['pmt']['current'] = deconstruct(-1e6 * v1/resistor)
-
-            if thread_up['labjack']:
-#                if 'pump' not in data: data['pump'] = {}
-                if 'pmt' not in data: data['pmt'] = {}
-                data['pmt']['gain'] = raw_data['labjack']['dac0']
-
-            if thread_up['plume-cam']:
-                data['ablation'] = {
-                    'center': raw_data['plume-cam']['center'],
-                    'intensity': raw_data['plume-cam']['intensity'],
-                    'saturation': raw_data['plume-cam']['saturation'],
-                }
-
-            if thread_up['interlock']:
-                data['interlock-uptime'] = raw_data['interlock']['uptime']
-
-
-            # Update models
-            try:
-                if thread_up['ctc'] and thread_up['mfc']:
-                    saph_temp = data['temperatures']['saph']
-
-                    if saph_temp is not None:
-                        growth_model.update(
-                            ufloat(*data['flows']['neon']),
-                            ufloat(*data['flows']['cell']),
-                            saph_temp
-                        )
-                        data['height'] = deconstruct(growth_model.height)
-
-                        if thread_up['fringe-cam']:
-                            fringe_counter.update(
-                                data['refl']['ai'][0],
-                                grow=(growth_model._growth_rate.n > 0)
-                            )
-                            if saph_temp > 13: fringe_counter.reset()
-                            data['fringe'] = {
-                                'count': fringe_counter.fringe_count,
-                                'ampl': fringe_counter.amplitude,
-                            }
-            except Exception as e:
-                print('Error:', e)
-
-
-#            if thread_up['scope'] and 'freq' in data:
-#                freq = None
-#
-#                if 'ti-saph' in data['freq']:
-#                    freq = ufloat(*data['freq']['ti-saph'])
-#                elif 'ti-saph-spec' in data['freq']:
-#                    freq = ufloat(*data['freq']['ti-saph-spec'])
-#
-#                if freq is not None:
-#                    v1 = ufloat(*data['pump']['v1'])
-#                    v2 = ufloat(*data['pump']['v2'])
-#
-#                    speed_of_light = 299792458
-#                    wl = speed_of_light / freq
-#
-#                    power_vert, power_horiz, angle = power_and_polarization(v1, v2, wl)
-#                    data['pump']['power'] = deconstruct(power_vert + power_horiz)
-#                    data['pump']['power-vert'] = deconstruct(power_vert)
-#                    data['pump']['power-horiz'] = deconstruct(power_horiz)
-#                    data['pump']['angle'] = deconstruct(angle)
-#
-#                    if 'eom-gain' in data['pump']:
-#                        gain = ufloat(*data['pump']['eom-gain'])
-#                        model_angle = eom_angle_from_gain(gain, wl)
-#                        data['pump']['angle-model'] = deconstruct(model_angle)
 
+def stale_connections(last_seen, now):
+    """Return threads to reconnect: in-process only, with no data for STALE_AFTER seconds."""
+    if not USE_INPROC: return []
+    return [key for key, t in last_seen.items() if now - t > STALE_AFTER]
 
-            # Add debug info
-            uptime = (time.monotonic() - publisher_start)/3600
-            data['debug'] = {
-                'uptime': uptime if loop_iteration > 1 else None,
-                'memory': memory_usage(),
-                'system-memory': round(psutil.virtual_memory().used / 1024),
-                'cpu': psutil.cpu_percent(),
-            }
-#            print_tree(data)
-#            print()
 
+def run_interval_loop(monitors, publisher):
+    """Poll every thread once per PUBLISH_INTERVAL, and publish whatever arrived."""
 
+    # Special case for spectrometer: keep cache of last datapoint
+    spec_cache = None
 
-            ### Limit publishing speed ###
-            target_end = PUBLISH_INTERVAL * loop_iteration + publisher_start
-            time.sleep(max(target_end - time.monotonic(), 0))
+    publisher_start = time.monotonic()
+    last_seen = {key: publisher_start for key in monitors.keys()}
+    for loop_iteration in itertools.count(1):
+        ##### Get data from all the threads. No need to change this part. #####
+        raw_data = {}
+        for key, monitor in monitors.items():
+            _, thread_data = monitor.latest()
+            if thread_data is not None:
+                raw_data[key] = thread_data
+                last_seen[key] = time.monotonic()
+
+        now = time.monotonic()
+        for key in stale_connections(last_seen, now):
+            monitors[key].make_connection()
+            last_seen[key] = now
+
+        thread_up = defaultdict(lambda: False, {
+            key: (key in raw_data)
+            for key in THREADS.keys()
+        })
+
+        # Artificially fill in values if spectrometer doesn't return anything
+        if 'spectrometer' in raw_data:
+            spec_cache = raw_data['spectrometer']
+        else:
+            raw_data['spectrometer'] = spec_cache
+
+        data = process_data(raw_data, thread_up, set(raw_data.keys()))
+        add_debug_info(data, publisher_start, first=(loop_iteration == 1))
+#        print_tree(data)
+#        print()
+
+
+        ### Limit publishing speed ###
+        target_end = PUBLISH_INTERVAL * loop_iteration + publisher_start
+        time.sleep(max(target_end - time.monotonic(), 0))
+
+        publisher.send(data)
+
+
+def run_event_loop(monitors, publisher):
+    """
+    Merge data from each thread as soon as it arrives, and publish
+    the merged state every PUBLISH_INTERVAL (or on change, if PUBLISH_ON_CHANGE).
+    A thread is considered up if it sent data within the last STALE_AFTER seconds.
+    """
+    poller = zmq.Poller()
+    sources = {}
+    for key, monitor in monitors.items():
+        poller.register(monitor.socket, zmq.POLLIN)
+        sources[monitor.socket] = key
+
+    raw_data = {}
+    last_update = {} # monotonic time of last message from each thread
+    updated = set()
+
+    publisher_start = time.monotonic()
+    last_publish = publisher_start
+    last_seen = {key: publisher_start for key in monitors.keys()} # last data or reconnect
+    for loop_iteration in itertools.count(1):
+        ##### Wait for new data until the next publish is due #####
+        while True:
+            interval = MIN_PUBLISH_INTERVAL if (PUBLISH_ON_CHANGE and updated) else PUBLISH_INTERVAL
+            timeout = last_publish + interval - time.monotonic()
+            if timeout <= 0: break
+
+            for socket, _ in poller.poll(timeout=1e3 * timeout):
+                key = sources[socket]
+                _, thread_data = monitors[key].latest()
+                if thread_data is None: continue
+
+                raw_data[key] = thread_data
+                last_update[key] = last_seen[key] = time.monotonic()
+                updated.add(key)
+
+        ##### Publish merged state #####
+        now = time.monotonic()
+        ages = {
+            key: (now - last_update[key]) if key in last_update else None
+            for key in THREADS.keys()
+        }
+        thread_up = defaultdict(lambda: False, {
+            key: (age is not None and age < STALE_AFTER)
+            for key, age in ages.items()
+        })
+
+        for key in stale_connections(last_seen, now):
+            poller.unregister(monitors[key].socket)
+            del sources[monitors[key].socket]
+            monitors[key].make_connection()
+            poller.register(monitors[key].socket, zmq.POLLIN)
+            sources[monitors[key].socket] = key
+            last_seen[key] = now
+
+        # Stale data is dropped, except for the spectrometer (keep last datapoint).
+        snapshot = copy_for_processing({
+            key: value for key, value in raw_data.items()
+            if thread_up[key] or key == 'spectrometer'
+        })
+        snapshot.setdefault('spectrometer', None)
+
+        data = process_data(snapshot, thread_up, updated)
+        data['source-age'] = ages
+        add_debug_info(data, publisher_start, first=(loop_iteration == 1))
+
+        publisher.send(data)
+        last_publish = time.monotonic()
+        updated = set()
 
-            publisher.send(data)
 
 
 ##### No need to touch the below code #####
@@ -278,13 +433,24 @@ def wrap_thread(name, thread_func):
 
 
 if __name__ == '__main__':
-    threads = {}
-    for key, thread_func in THREADS.items():
-        thread = threading.Thread(target=lambda: wrap_thread(key, thread_func))
-        thread.start()
-        threads[key] = thread
-
-    run_publisher()
-
-    # Quit all threads gracefully
-    for thread in threads.values(): thread.join()
+    if ISOLATION == 'process':
+        supervisor = Supervisor({
+            key: functools.partial(wrap_thread, key, thread_func)
+            for key, thread_func in THREADS.items()
+        }, heartbeat_timeout=HEARTBEAT_TIMEOUT)
+        supervisor.start()
+
+        run_publisher()
+    else:
+        use_inproc(USE_INPROC, tcp=EXPOSE_TCP)
+
+        threads = {}
+        for key, thread_func in THREADS.items():
+            thread = threading.Thread(target=wrap_thread, args=(key, thread_func))
+            thread.start()
+            threads[key] = thread
+
+        run_publisher()
+
+        # Quit all threads gracefully
+        for thread in threads.values(): thread.join()
@@ -1,10 +1,13 @@
 import time
+from contextlib import ExitStack
+
 import numpy as np
 import cv2
 
 from simple_pyspin import Camera
 
 from headers.zmq_server_socket import create_server
+from headers.frame_ring import FrameWriter, SEND_PNG
 from headers.util import unweighted_mean
 from headers.edm_util import deconstruct, Timer
 
@@ -24,11 +27,16 @@ def camera_thread():
 
     fringe_model = FringeModel()
 
-    with create_server('fringe-cam') as publisher:
+    with create_server('fringe-cam') as publisher, ExitStack() as stack:
+        frames = {
+            key: stack.enter_context(FrameWriter(f'fringe-cam-{key}'))
+            for key in ['raw', 'fringe', 'fringe-annotated']
+        }
+
         while True:
             center = {}
             refl = {}
-            png = {}
+            images = {}
 
             camera_samples = []
             exposure = camera.ExposureTime
@@ -57,9 +65,9 @@ def camera_thread():
                 image = (image/256 + 0.5).astype(np.uint8)
 
             # Save images
-            png['raw'] = cv2.imencode('.png', image)[1].tobytes()
-            png['fringe']  = cv2.imencode('.png', fringe_model.scaled_pattern)[1].tobytes()
-            png['fringe-annotated']  = cv2.imencode('.png', fringe_model.annotated_pattern)[1].tobytes()
+            images['raw'] = image
+            images['fringe'] = fringe_model.scaled_pattern
+            images['fringe-annotated'] = fringe_model.annotated_pattern
 
             # Store data
             center['x'] = deconstruct(center_x)
@@ -73,8 +81,11 @@ def camera_thread():
             if saturation.n > 99: camera.ExposureTime = exposure // 2
             if saturation.n < 30: camera.ExposureTime = exposure * 2
 
-            publisher.send({
+            message = {
                 'center': center,
                 'refl': refl,
-                'png': png,
-            })
+                'frames': {key: frames[key].write(images[key]) for key in images.keys()},
+            }
+            if SEND_PNG:
+                message['png'] = {key: cv2.imencode('.png', images[key])[1].tobytes() for key in images.keys()}
+            publisher.send(message)
@@ -1,27 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from headers.zmq_server_socket import create_server
 
 from headers.CTC100 import CTC100
 
+
+def read_thermometer(thermometer):
+    """Read all channels of one controller (one batched query). Returns (temperatures, heaters)."""
+    obj, temp_channels, heater_channels = thermometer
+    values = obj.read_many(temp_channels + heater_channels)
+    return (
+        {channel: values[channel] for channel in temp_channels},
+        {channel: values[channel] for channel in heater_channels},
+    )
+
+
 def ctc_thread():
     thermometers = [
         (CTC100(31415), ['saph', 'mirror', 'bott hs', 'srb4k'], ['heat saph', 'heat mirror']),
         (CTC100(31416), ['cell', '45k plate', '4k plate'], ['srb45k out', 'heat cell'])
     ]
 
-    with create_server('ctc') as publisher:
+    # Each controller has its own multiplexer connection, so they can be read concurrently.
+    with create_server('ctc') as publisher, ThreadPoolExecutor(len(thermometers)) as pool:
         while True:
             ##### Read thermometers #####
             temperatures = {}
             heaters = {}
 
-            for thermometer in thermometers:
-                obj, temp_channels, heater_channels = thermometer
-
-                for channel in temp_channels:
-                    temperatures[channel] = obj.read(channel)
-
-                for channel in heater_channels:
-                    heaters[channel] = obj.read(channel)
+            for temps, heats in pool.map(read_thermometer, thermometers):
+                temperatures.update(temps)
+                heaters.update(heats)
 
             publisher.send({
                 'temperatures': temperatures,
@@ -12,7 +12,7 @@ def interlock_thread():
     start_time = time.monotonic()
     with create_server('interlock') as publisher:
         while True:
-            _, data = temp_monitor.grab_json_data()
+            _, data = temp_monitor.latest()
             if data is not None:
                 verdi_temp = data['status']['temp']['baseplate']
                 power = data['status']['power']
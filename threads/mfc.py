@@ -9,10 +9,9 @@ def mfc_thread():
 
     with create_server('mfc') as publisher:
         while True:
-            publisher.send({
-                'cell': deconstruct(mfc.flow_rate_cell),
-                'cell1': deconstruct(mfc.flow_rate_cell_1),
-                'cell2': deconstruct(mfc.flow_rate_cell_2),
-                'neon': deconstruct(mfc.flow_rate_neon_line),
-            })
+            flows = mfc.read_all()
+
+            # Multiplexer didn't respond; try again next cycle
+            if flows is not None:
+                publisher.send({key: deconstruct(flow) for key, flow in flows.items()})
             time.sleep(0.5)
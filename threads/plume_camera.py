@@ -5,6 +5,7 @@ import cv2
 from simple_pyspin import Camera
 
 from headers.zmq_server_socket import create_server
+from headers.frame_ring import FrameWriter, SEND_PNG
 from headers.edm_util import deconstruct
 
 from models.image_track import fit_image_spot
@@ -28,7 +29,7 @@ def plume_camera_thread():
 
     camera.start()
 
-    with create_server('plume-cam') as publisher:
+    with create_server('plume-cam') as publisher, FrameWriter('plume-cam') as frames:
         while True:
             image = camera.get_array()
             timestamp = time.time()
@@ -38,10 +39,7 @@ def plume_camera_thread():
             if isinstance(image[0][0], np.uint16):
                 image = np.minimum(image/256 + 0.5, 255).astype(np.uint8)
 
-            # Encode PNG
-            png = cv2.imencode('.png', image)[1].tobytes()
-
-            publisher.send({
+            message = {
                 'timestamp': timestamp,
                 'center': {
                     'x': deconstruct(cx),
@@ -49,7 +47,9 @@ def plume_camera_thread():
                 },
                 'intensity': intensity,
                 'saturation': saturation,
-                'png': png,
-            })
+                'frame': frames.write(image, timestamp),
+            }
+            if SEND_PNG: message['png'] = cv2.imencode('.png', image)[1].tobytes()
+            publisher.send(message)
 
             time.sleep(0.05)
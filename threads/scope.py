@@ -28,9 +28,9 @@ def scope_thread():
             ch2_mean = ufloat(np.mean(ch2), np.std(ch2))
 
             publisher.send({
-                'times': list(times),
-                'ch1-raw': list(ch1),
-                'ch2-raw': list(ch2),
+                'times': times,
+                'ch1-raw': ch1,
+                'ch2-raw': ch2,
                 'ch1': deconstruct(ch1_mean),
                 'ch2': deconstruct(ch2_mean),
             })
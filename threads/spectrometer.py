@@ -6,9 +6,7 @@ from headers.util import nom, std, unweighted_mean
 
 
 def spectrometer_thread():
-    spectrometer = OceanFX()
-
-    with create_server('spectrometer') as publisher:
+    with OceanFX() as spectrometer, create_server('spectrometer') as publisher:
         while True:
             trans = {}
             rough = {}
@@ -31,19 +29,20 @@ def spectrometer_thread():
             rough['fourth-order'] = deconstruct(beta_4)
             rough['chisq'] = chisq
 
+            # Arrays are sent as-is (zero-copy binary frames).
             data = {
-                'wavelengths': list(spectrometer.wavelengths),
+                'wavelengths': spectrometer.wavelengths,
                 'intensities': {
-                    'nom': list(nom(spectrum)),
-                    'std': list(std(spectrum)),
+                    'nom': nom(spectrum),
+                    'std': std(spectrum),
                 },
                 'intercepts': {
-                    'nom': list(nom(spectrometer._intercepts)),
-                    'std': list(std(spectrometer._intercepts)),
+                    'nom': nom(spectrometer._intercepts),
+                    'std': std(spectrometer._intercepts),
                 },
                 'fit': {
-                    'num-points': list(nom(spectrometer._points)),
-                    'chisq-array': list(spectrometer._chisqs),
+                    'num-points': spectrometer._points,
+                    'chisq-array': spectrometer._chisqs,
                     'chisq': deconstruct(spectrometer.chisq),
                 },
                 'rough': rough,
@@ -19,6 +19,13 @@ def wa1000_wavemeter_thread():
             publisher.send({'wavelength': deconstruct(wavemeter.wavelength)})
 
 
+# Sample continuously, and publish statistics of the samples every PUBLISH_INTERVAL seconds.
+# Each sample is one batched request to the wavemeter server. Windows don't overlap,
+# so consecutive published values are independent.
+PUBLISH_INTERVAL = 1.0 # s
+SAMPLE_INTERVAL = 5e-3 # s, faster than the wavemeter updates. Repeated readings are dropped.
+
+
 def wavemeter_thread():
     wm = WM()
 
@@ -27,47 +34,57 @@ def wavemeter_thread():
         'multiplexed': 8,
     }
 
+    # One batched read per sample: temperature, then (frequency, power, voltage) per channel
+    methods = {
+        'freq': 'read_frequency',
+        'power': 'read_laser_power',
+        'voltages': 'get_external_output',
+#        'linewidth': 'read_linewidth',
+    }
+    columns = [('temp', None)] + [(key, c) for c in channels.keys() for key in methods.keys()]
+    requests = [('read_temperature',)] + [(methods[key], channels[c]) for key, c in columns[1:]]
+
+    # Columns that are measured together, keyed by the first one: temperature, then each channel
+    groups = [[0]] + [[columns.index((key, c)) for key in methods.keys()] for c in channels.keys()]
+
+    samples = []
+
+    def statistics():
+        rows = np.array(samples, dtype=float).reshape(-1, len(columns))
+
+        stats = {}
+        for column, values in zip(columns, rows.T):
+            values = values[np.isfinite(values)]
+            if len(values) > 1: stats[column] = (np.mean(values), np.std(values, ddof=1))
+        return stats
+
     with create_server('wavemeter') as publisher:
+        last_publish = time.monotonic()
+        previous = None
         while True:
-            frequencies = {}
-            powers = {}
-            voltages = {}
-#            linewidths = {}
-
-            freq_samples = {c: [] for c in channels.keys()}
-            power_samples = {c: [] for c in channels.keys()}
-            volt_samples = {c: [] for c in channels.keys()}
-#            linewidth_samples = {c: [] for c in channels.keys()}
-            temp_samples = []
-            for i in range(8):
-                temp_samples.append(wm.read_temperature())
-                time.sleep(5e-3)
-
-                for c, c_num in channels.items():
-                    for method, dst in [
-                        (wm.read_frequency, freq_samples),
-                        (wm.read_laser_power, power_samples),
-                        (wm.get_external_output, volt_samples),
-#                        (wm.read_linewidth, linewidth_samples),
-                    ]:
-                        sample = method(c_num)
-                        if isinstance(sample, float): dst[c].append(sample)
-                        time.sleep(5e-3)
-
-            for src, dst in [
-                (freq_samples, frequencies),
-                (power_samples, powers),
-                (volt_samples, voltages),
-#                (linewidth_samples, linewidths),
-            ]:
-                for key, vals in src.items():
-                    if len(vals) > 1:
-                        dst[key] = (np.mean(vals), np.std(vals, ddof=1))
-
-            publisher.send({
-                'freq': frequencies,
-                'power': powers,
-                'voltages': voltages,
-#                'linewidth': linewidths,
-                'temp': (np.mean(temp_samples), np.std(temp_samples, ddof=1))
-            })
+            row = [np.nan if x is None else x for x in wm.read_many(requests)]
+
+            # Only keep the temperature and channels with a new measurement (changed since the last sample),
+            # so readings repeated between wavemeter updates don't shrink the standard deviation
+            if row != previous:
+                sample = list(row)
+                if previous is not None:
+                    for group in groups:
+                        if row[group[0]] == previous[group[0]]:
+                            for i in group: sample[i] = np.nan
+                samples.append(sample)
+                previous = row
+
+            now = time.monotonic()
+            if now - last_publish >= PUBLISH_INTERVAL:
+                last_publish = now
+                stats = statistics()
+                samples.clear()
+
+                data = {key: {} for key in methods.keys()}
+                for (key, c), value in stats.items():
+                    if c is not None: data[key][c] = value
+                if ('temp', None) in stats: data['temp'] = stats[('temp', None)]
+                publisher.send(data)
+
+            time.sleep(SAMPLE_INTERVAL)
@@ -6,6 +6,7 @@ import cv2
 from headers.oceanfx import OceanFX
 from headers.zmq_server_socket import create_server
 from headers.zmq_client_socket import connect_to
+from headers.frame_ring import FrameWriter, SEND_PNG
 
 from headers.edm_util import add_timestamp
 
@@ -38,7 +39,7 @@ def webcam_thread():
 
     publisher_socket = connect_to('edm-monitor')
 
-    with create_server('webcam') as publisher:
+    with create_server('webcam') as publisher, FrameWriter('webcam') as frames:
         label = ''
         for i in itertools.count():
             ret, saph_image = webcam.read()
@@ -50,9 +51,9 @@ def webcam_thread():
 #            resized = cv2.resize(saph_image, (960, 540))
             fragment = saph_image[200:800, 800:1300]
 
-            raw_png = cv2.imencode('.png', fragment)[1].tobytes()
-
-            publisher.send({
-                'raw': raw_png,
+            message = {
+                'frame': frames.write(fragment),
                 'index': i,
-            })
+            }
+            if SEND_PNG: message['raw'] = cv2.imencode('.png', fragment)[1].tobytes()
+            publisher.send(message)